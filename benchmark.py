@@ -0,0 +1,293 @@
+'''Benchmarks of the metaclass interfaces against synthetic data.
+
+Run with a throwaway local mongod if one is on PATH, else with mongomock:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --backend mongomock --codes 20 --years 3
+    python benchmark.py --compare bench.json
+
+Results are written as JSON so runs of different commits can be compared.
+'''
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from statistics import mean, median
+from time import perf_counter, sleep
+
+import pandas as pd
+
+from fdm.utils.test import ord_test_feeder_func, test_config
+from fdm.utils.data_structure import Bubbles
+from fdm.utils.data_structure.bubbles import TimeBubble
+from fdm.datasources.metaclass.interface import (ColInterface,
+                                                 DynColInterface,
+                                                 PackedStaColInterface,
+                                                 StaColInterface)
+
+SETTING = test_config['Test']['DBSetting']
+
+
+# ------------------------------
+# Backends
+# ------------------------------
+
+@contextmanager
+def mongod_client():
+    '''Start a throwaway mongod on a free port, drop it on exit.'''
+    from pymongo import MongoClient
+    dbpath = tempfile.mkdtemp(prefix='fdm_bench_')
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    proc = subprocess.Popen(['mongod', '--dbpath', dbpath, '--port', str(port),
+                             '--bind_ip', '127.0.0.1', '--quiet'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = MongoClient('127.0.0.1', port, serverSelectionTimeoutMS=500)
+    try:
+        for _ in range(60):
+            try:
+                client.admin.command('ping')
+                break
+            except Exception:
+                sleep(0.5)
+        else:
+            raise RuntimeError('mongod did not start on port {0}'.format(port))
+        yield client
+    finally:
+        client.close()
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(dbpath, ignore_errors=True)
+
+
+@contextmanager
+def mongomock_client():
+    import mongomock
+    yield mongomock.MongoClient()
+
+
+def open_backend(name):
+    if name == 'auto':
+        name = 'mongod' if shutil.which('mongod') else 'mongomock'
+    backends = {'mongod': mongod_client, 'mongomock': mongomock_client}
+    return name, backends[name]()
+
+
+# ------------------------------
+# Synthetic data
+# ------------------------------
+
+def gen_codes(n):
+    return ['{0:06d}.SZ'.format(i) for i in range(n)]
+
+
+def gen_universe(codes, start, end) -> pd.DataFrame:
+    '''Daily records of every code built from the test feeder.'''
+    frames = [ord_test_feeder_func(code, 'close', start, end)
+              for code in codes]
+    return pd.concat(frames, ignore_index=True)
+
+
+def gen_holed_bubbles(n):
+    '''Bubbles over n days with every third day removed.'''
+    start = datetime(1990, 1, 1)
+    res = Bubbles([[start, start + timedelta(n)]])
+    for i in range(0, n, 3):
+        day = start + timedelta(i)
+        res = res.carve(TimeBubble(day, day + timedelta(1)))
+    return res
+
+
+# ------------------------------
+# Runner
+# ------------------------------
+
+def timeit(func, setup=None, repeat=3) -> dict:
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t = perf_counter()
+        func()
+        runs.append(perf_counter() - t)
+    return {'runs': runs, 'min': min(runs), 'median': median(runs), 'mean': mean(runs)}
+
+
+def run(client, backend, ncodes, nyears, repeat) -> list:
+    db = client['fdm_benchmark']
+    codes = gen_codes(ncodes)
+    start = datetime(2019 - nyears + 1, 1, 1)
+    end = datetime(2019, 12, 31)
+    universe = gen_universe(codes, start, end)
+    results = []
+
+    def bench(name, func, setup=None):
+        res = timeit(func, setup, repeat)
+        res['name'] = name
+        results.append(res)
+        print('{0:<40} min {1:>9.4f}s  median {2:>9.4f}s'.format(
+            name, res['min'], res['median']))
+
+    # ColInterface
+    ci = ColInterface(db['price'], SETTING)
+
+    def reset_price():
+        ci.drop()
+
+    bench('ColInterface.insert_many',
+          lambda: ci.insert_many(universe.copy()), reset_price)
+    ci.insert_many(universe.copy())
+    ci.create_indexs()
+    bench('ColInterface.query',
+          lambda: ci.query(startdate=start, enddate=end))
+    bench('ColInterface.query codes',
+          lambda: ci.query(codes[:5], startdate=start, enddate=end))
+    bench('ColInterface.query workers=1',
+          lambda: ci.query(startdate=start, enddate=end, workers=1))
+    if backend == 'mongod':
+        bench('ColInterface.query columnar',
+              lambda: ci.query(startdate=start, enddate=end, engine='columnar'))
+    bench('ColInterface.query freq=M ffill',
+          lambda: ci.query(startdate=start, enddate=end, freq='M', fillna='ffill'))
+    bench('ColInterface.rolling_query W-FRI',
+          lambda: list(ci.rolling_query(4, startdate=start, enddate=end, freq='W-FRI')))
+    bench('ColInterface.rolling_query B desc',
+          lambda: list(ci.rolling_query(2, startdate=end - timedelta(60),
+                                        enddate=end, ascending=False)))
+
+    # StaColInterface
+    fields = ['f1', 'f2']
+    sta = None
+
+    def reset_sta():
+        nonlocal sta
+        client.drop_database('fdm_benchmark_sta')
+        sta = StaColInterface(client['fdm_benchmark_sta']['sta'],
+                              ord_test_feeder_func, SETTING)
+
+    def sta_query(**kwargs):
+        return sta.query(codes, fields, start, end, **kwargs)
+
+    bench('StaColInterface.query with update', sta_query, reset_sta)
+    bench('StaColInterface.query skip update',
+          lambda: sta_query(skip_update=True))
+    bench('StaColInterface.query up to date', sta_query)
+    bench('FieldStatus lookup',
+          lambda: sta.manager.status[codes, fields])
+    bench('Manager.solve_update_params',
+          lambda: list(sta.manager.solve_update_params(codes, fields, start, end)))
+
+    # PackedStaColInterface
+    packed = None
+
+    def reset_packed():
+        nonlocal packed
+        client.drop_database('fdm_benchmark_packed')
+        packed = PackedStaColInterface(client['fdm_benchmark_packed']['sta'],
+                                       ord_test_feeder_func, SETTING)
+
+    def packed_query(**kwargs):
+        return packed.query(codes, fields, start, end, **kwargs)
+
+    bench('PackedStaColInterface.query with update', packed_query, reset_packed)
+    bench('PackedStaColInterface.query skip update',
+          lambda: packed_query(skip_update=True))
+    bench('PackedStaColInterface.query 5 codes',
+          lambda: packed.query(codes[:5], fields, start, end, skip_update=True))
+    bench('StaColInterface.query 5 codes',
+          lambda: sta.query(codes[:5], fields, start, end, skip_update=True))
+
+    # DynColInterface
+    dyn = None
+
+    def reset_dyn():
+        nonlocal dyn
+        client.drop_database('fdm_benchmark_dyn')
+        dyn = DynColInterface(client['fdm_benchmark_dyn']['dyn'],
+                              ord_test_feeder_func, SETTING)
+
+    dyn_codes = codes[:min(len(codes), 5)]
+    bench('DynColInterface.query with update',
+          lambda: dyn.query(dyn_codes, fields, start, end), reset_dyn)
+    bench('DynColInterface.query up to date',
+          lambda: dyn.query(dyn_codes, fields, start, end))
+
+    # Bubbles
+    ndays = 365 * nyears
+    holed = gen_holed_bubbles(ndays)
+    target = TimeBubble(start, end)
+    bench('Bubbles build holed', lambda: gen_holed_bubbles(ndays))
+    bench('Bubbles.from list', lambda: Bubbles(holed.to_list()))
+    bench('Bubbles.gaps', lambda: holed.gaps(target))
+    bench('Bubbles.merge', lambda: holed.merge(target))
+    bench('Bubbles.carve', lambda: holed.carve(target))
+    bench('Bubbles.intersect', lambda: holed.intersect(target))
+
+    for name in ('fdm_benchmark', 'fdm_benchmark_sta', 'fdm_benchmark_packed',
+                 'fdm_benchmark_dyn'):
+        client.drop_database(name)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ''
+
+
+def compare(results: list, path: str):
+    with open(path, 'r', encoding='utf-8') as file:
+        old = {r['name']: r for r in json.loads(file.read())['results']}
+    print('\n{0:<40} {1:>10} {2:>10} {3:>8}'.format(
+        'benchmark', 'old', 'new', 'ratio'))
+    for r in results:
+        if r['name'] in old:
+            o = old[r['name']]['median']
+            print('{0:<40} {1:>10.4f} {2:>10.4f} {3:>8.2f}'.format(
+                r['name'], o, r['median'], r['median'] / o if o else float('nan')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--backend', default='auto',
+                        choices=['auto', 'mongod', 'mongomock'])
+    parser.add_argument('--codes', type=int, default=50)
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None,
+                        help='file to write JSON results to')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    backend, ctx = open_backend(args.backend)
+    print('Backend: {0}, codes: {1}, years: {2}'.format(
+        backend, args.codes, args.years))
+    with ctx as client:
+        results = run(client, backend, args.codes, args.years, args.repeat)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(),
+        'backend': backend,
+        'params': {'codes': args.codes, 'years': args.years, 'repeat': args.repeat},
+        'results': results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(report, indent=2))
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
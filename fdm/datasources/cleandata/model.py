@@ -1,11 +1,14 @@
+import os
 from datetime import timedelta
 from datetime import datetime
 
 import pandas as pd
+from pandas import DataFrame
 
 from fdm.datasources.metaclass import _CollectionBase, _DbBase
 import fdm
 from .feeder import feeder_funcs
+from .panel import PricePanel
 
 
 class CleanData(_DbBase):
@@ -19,7 +22,19 @@ class CleanData(_DbBase):
 class Price(_CollectionBase):
     '''Collection of market price.
     Collection scheme:
-    |code|date|open|high|low|close|vwap|adj_factor|'''
+    |code|date|open|high|low|close|vwap|adj_factor|
+
+    With panel_path in setting, a memory mapped date x code panel of every
+    price field is kept in sync on update, see panel_view.'''
+
+    def __init__(self, col, setting: dict):
+        super().__init__(col, setting)
+        path = setting.get('panel_path', '')
+        if path:
+            self.panel = PricePanel(os.path.join(
+                path, col.database.name, col.name))
+        else:
+            self.panel = None
 
     def update(self, source: str = 'tushare'):
         '''Update database to the latest from source'''
@@ -30,12 +45,28 @@ class Price(_CollectionBase):
             if lastdate < enddate:
                 df = function(lastdate, enddate)
         self.interface.insert_many(df)
+        self.sync_panel()
         return 0
 
+    def sync_panel(self) -> int:
+        '''Append dates after the last panel row, return number of dates added.'''
+        if self.panel is None:
+            return 0
+        return self.panel.sync(self.interface)
+
+    def panel_view(self, field: str = 'close', startdate: datetime = None,
+                   enddate: datetime = None, codes: list = None) -> DataFrame:
+        '''Return date x code DataFrame of field read from the panel.'''
+        if self.panel is None:
+            raise KeyError('Unexpected panel setting: set panel_path first')
+        return self.panel.view(field, startdate, enddate, codes)
+
     def rebuild(self, source: str = 'tushare'):
         '''Rebuild database from source'''
         # Clean database
         self.interface.drop()
+        if self.panel is not None:
+            self.panel.clear()
         # Get the correct data fetching function base on class name of "source"
         function = feeder_funcs[source]
         startdate = datetime(1990, 1, 1)
@@ -0,0 +1,213 @@
+import json
+import os
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+# Fields kept as date x code panels
+PANEL_FIELDS = ('open', 'high', 'low', 'close', 'vwap', 'adj_factor')
+
+
+class PricePanel:
+    '''Date x code float64 panels of a price collection on disk.
+
+    Layout under path:
+        meta.json               codes, number of dates, code capacity and
+                                file of every field
+        dates.i8                datetime64[ns] of every row as int64
+        <field>.<capacity>.f8   row major (dates, capacity) float64 matrix
+    Rows are only ever appended and always written in full (NaN for codes
+    without record), meta.json is replaced last, so readers in other
+    processes see either the old or the new panel. New codes take spare
+    columns, when full the fields are copied to new files with a doubled
+    capacity, switched to by meta.json, and the old files removed after.
+
+    Readers get DataFrames backed by read only memmaps, slicing dates keeps
+    the view, selecting codes copies.
+    '''
+
+    def __init__(self, path: str, fields=PANEL_FIELDS):
+        self.path = os.path.expanduser(path)
+        self.fields = list(fields)
+        self._lock = Lock()
+
+    # ----------------------------------------
+    # Meta
+    # ----------------------------------------
+    def meta(self) -> dict:
+        try:
+            with open(os.path.join(self.path, 'meta.json'), 'r', encoding='utf-8') as file:
+                return json.loads(file.read())
+        except (OSError, ValueError):
+            return {'codes': [], 'n_dates': 0, 'capacity': 0, 'files': {}}
+
+    def _write_meta(self, meta: dict):
+        tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(meta))
+        os.replace(tmp, os.path.join(self.path, 'meta.json'))
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @staticmethod
+    def _field_file(meta: dict, field: str) -> str:
+        # Panels written before capacity was in file names have no files
+        return meta.get('files', {}).get(field, field + '.f8')
+
+    def dates(self, meta: dict = None) -> pd.DatetimeIndex:
+        meta = self.meta() if meta is None else meta
+        if meta['n_dates'] == 0:
+            return pd.DatetimeIndex([])
+        raw = np.memmap(self._file('dates.i8'), dtype='int64', mode='r',
+                        shape=(meta['n_dates'],))
+        return pd.DatetimeIndex(raw.view('datetime64[ns]'))
+
+    def lastdate(self) -> Optional[datetime]:
+        dates = self.dates()
+        return None if len(dates) == 0 else dates[-1].to_pydatetime()
+
+    # ----------------------------------------
+    # Read
+    # ----------------------------------------
+    def view(self, field: str, startdate: datetime = None, enddate: datetime = None,
+             codes: list = None) -> DataFrame:
+        '''Return date x code DataFrame of field backed by the memmap.'''
+        if field not in self.fields:
+            raise KeyError('Unexpected panel field: {0}'.format(field))
+        try:
+            meta = self.meta()
+            mm = self._open(meta, field)
+        except FileNotFoundError:
+            # Files grown and removed after meta was read
+            meta = self.meta()
+            mm = self._open(meta, field)
+        dates = self.dates(meta)
+        if len(dates) == 0:
+            return DataFrame()
+        s = 0 if startdate is None else dates.searchsorted(startdate, 'left')
+        e = len(dates) if enddate is None else dates.searchsorted(enddate, 'right')
+        df = DataFrame(mm[s:e, :len(meta['codes'])], index=dates[s:e],
+                       columns=meta['codes'], copy=False)
+        df.index.name = 'date'
+        if codes is not None:
+            df = df.reindex(columns=codes)
+        return df
+
+    def _open(self, meta: dict, field: str) -> Optional[np.memmap]:
+        if meta['n_dates'] == 0:
+            return None
+        return np.memmap(self._file(self._field_file(meta, field)), dtype='float64',
+                         mode='r', shape=(meta['n_dates'], meta['capacity']))
+
+    # ----------------------------------------
+    # Write
+    # ----------------------------------------
+    def append(self, df: DataFrame, code_name='code', date_name='date'):
+        '''Append long format records dated after the last row.'''
+        with self._lock:
+            meta = self.meta()
+            lastdate = self.lastdate()
+            if lastdate is not None:
+                df = df[df[date_name] > lastdate]
+            if df.empty:
+                return 0
+            os.makedirs(self.path, exist_ok=True)
+
+            df = df.drop_duplicates([date_name, code_name], keep='last')
+            codes = meta['codes'] + sorted(
+                set(df[code_name].unique()) - set(meta['codes']))
+            old_files = []
+            if len(codes) > meta['capacity']:
+                old_files = self._grow(
+                    meta, max(len(codes), 2 * meta['capacity'], 64))
+
+            dates = pd.DatetimeIndex(sorted(df[date_name].unique()))
+            rows = dates.get_indexer(df[date_name])
+            cols = pd.Index(codes).get_indexer(df[code_name])
+            for field in self.fields:
+                block = np.full((len(dates), meta['capacity']), np.nan)
+                if field in df.columns:
+                    block[rows, cols] = df[field].to_numpy(dtype='float64')
+                self._append_rows(self._field_file(meta, field), block,
+                                  meta['n_dates'])
+            self._append_rows('dates.i8', dates.values.view('int64'),
+                              meta['n_dates'])
+
+            meta['codes'] = codes
+            meta['n_dates'] += len(dates)
+            self._write_meta(meta)
+            # Readers holding the old meta map old files until done
+            for name in old_files:
+                if os.path.exists(self._file(name)):
+                    os.remove(self._file(name))
+            return len(dates)
+
+    def _append_rows(self, name: str, block: np.ndarray, n_rows: int):
+        '''Write block after the first n_rows rows, dropping anything beyond.'''
+        path = self._file(name)
+        offset = n_rows * block.itemsize * \
+            (block.shape[1] if block.ndim == 2 else 1)
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as file:
+            file.truncate(offset)
+            file.seek(offset)
+            file.write(np.ascontiguousarray(block).tobytes())
+
+    def _grow(self, meta: dict, capacity: int) -> list:
+        '''Copy field files to new files with more code columns.
+
+        meta is updated to the new files but not written, return names of
+        the old files to remove once it is.'''
+        n = meta['n_dates']
+        files = {}
+        old_files = []
+        for field in self.fields:
+            name = '{0}.{1}.f8'.format(field, capacity)
+            new = np.full((n, capacity), np.nan)
+            if n != 0 and meta['capacity'] != 0:
+                old_name = self._field_file(meta, field)
+                old = np.memmap(self._file(old_name), dtype='float64', mode='r',
+                                shape=(n, meta['capacity']))
+                new[:, :meta['capacity']] = old
+                del old
+                old_files.append(old_name)
+            new.tofile(self._file(name))
+            files[field] = name
+        meta['capacity'] = capacity
+        meta['files'] = files
+        return old_files
+
+    def sync(self, interface, startdate: datetime = None):
+        '''Append records of a ColInterface after the last row, year by year.'''
+        lastdate = self.lastdate()
+        if lastdate is not None:
+            startdate = lastdate + timedelta(1)
+        years = [int(y) for y in interface.list_subcollection_names()]
+        if len(years) == 0:
+            return 0
+        start_year = years[0] if startdate is None else startdate.year
+        fields = [interface.code_name, interface.date_name] + self.fields
+        n = 0
+        for year in range(start_year, years[-1] + 1):
+            s = datetime(year, 1, 1)
+            if startdate is not None:
+                s = max(s, startdate)
+            df = interface.query(startdate=s, enddate=datetime(year, 12, 31),
+                                 fields=fields)
+            if not df.empty:
+                n += self.append(df, interface.code_name, interface.date_name)
+        return n
+
+    def clear(self):
+        with self._lock:
+            if not os.path.isdir(self.path):
+                return
+            fields = tuple(f + '.' for f in self.fields)
+            for name in os.listdir(self.path):
+                if (name.startswith(fields) and name.endswith('.f8')) or \
+                        name in ('dates.i8', 'meta.json'):
+                    os.remove(self._file(name))
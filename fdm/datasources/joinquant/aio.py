@@ -0,0 +1,96 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from pandas import DataFrame
+
+from .api import JQDataAPI, QuotaExhaustedError
+
+
+class AsyncJQDataAPI:
+    '''asyncio front end of JQDataAPI loaders.
+
+    Loader calls run on a thread pool over the shared keep-alive transport,
+    at most `concurrency` of them at a time. The remaining daily quota is
+    read before the first call and again every `check_every` calls, in
+    between it is decreased by the rows returned. Calls stop with
+    QuotaExhaustedError once it would fall below `reserve`.
+
+    Usage:
+        api = AsyncJQDataAPI(concurrency=8)
+        res = api.run('get_price_period', [(code, start, end), ...])
+    '''
+
+    def __init__(self, concurrency: int = 8, reserve: int = 10000, check_every: int = 200):
+        self.api = JQDataAPI()
+        self.concurrency = concurrency
+        self.reserve = reserve
+        self.check_every = check_every
+        self.quota = None
+        self._since_check = 0
+
+    # ----------Quota----------
+    async def query_count(self, executor=None) -> int:
+        '''Read remaining daily quota from JQData.'''
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(executor, JQDataAPI.get_query_count)
+        return int(text.strip())
+
+    async def _ensure_quota(self, lock: asyncio.Lock, executor):
+        async with lock:
+            if self.quota is None or self._since_check >= self.check_every:
+                self.quota = await self.query_count(executor)
+                self._since_check = 0
+            if self.quota <= self.reserve:
+                raise QuotaExhaustedError(
+                    'Remaining quota {0} reached reserve {1}.'.format(self.quota, self.reserve))
+
+    def _consume(self, res):
+        rows = len(res) if isinstance(res, (DataFrame, list)) else 1
+        self.quota -= max(rows, 1)
+        self._since_check += 1
+
+    # ----------Loaders----------
+    async def call(self, method: str, *args, semaphore=None, lock=None, executor=None):
+        '''Call one JQDataAPI loader, e.g. call('get_price_period', code, start, end).'''
+        semaphore = asyncio.Semaphore(1) if semaphore is None else semaphore
+        lock = asyncio.Lock() if lock is None else lock
+        async with semaphore:
+            await self._ensure_quota(lock, executor)
+            loop = asyncio.get_running_loop()
+            func = getattr(self.api, method)
+            res = await loop.run_in_executor(executor, partial(func, *args))
+            self._consume(res)
+            return res
+
+    async def map(self, method: str, args_list: list) -> list:
+        '''Call a loader for every args tuple concurrently.
+
+        Results keep the order of args_list, a failed call leaves its
+        exception in place of the result.'''
+        semaphore = asyncio.Semaphore(self.concurrency)
+        lock = asyncio.Lock()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            tasks = [self.call(method, *args, semaphore=semaphore,
+                               lock=lock, executor=executor)
+                     for args in args_list]
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self, method: str, args_list: list) -> list:
+        '''Blocking version of map, also works inside a running event loop.'''
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.map(method, args_list))
+        # Inside a running loop (e.g. notebook), use a loop of another thread
+        with ThreadPoolExecutor(max_workers=1) as exe:
+            return exe.submit(asyncio.run, self.map(method, args_list)).result()
+
+    async def get_price_period(self, code, start, end) -> DataFrame:
+        return await self.call('get_price_period', code, start, end)
+
+    async def get_financial_statement(self, code, table, start, end) -> DataFrame:
+        return await self.call('get_financial_statement', code, table, start, end)
+
+    async def get_industry_stocks(self, code, date) -> list:
+        return await self.call('get_industry_stocks', code, date)
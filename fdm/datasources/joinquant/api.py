@@ -2,8 +2,10 @@ from datetime import datetime, timedelta
 import json
 from functools import wraps
 from io import StringIO
+from threading import local, Lock
 
 import requests as r
+from requests.adapters import HTTPAdapter
 import pandas as pd
 from pandas import DataFrame
 
@@ -12,9 +14,66 @@ class NonAuthorizedError(Exception):
     pass
 
 
+class QuotaExhaustedError(Exception):
+    pass
+
+
+# Markers of JQData error responses
+TOKEN_EXPIRED = 'token'
+QUOTA_EXHAUSTED = '查询限制'
+
+
+class HTTPTransport:
+    '''Keep-alive HTTP transport shared by all JQDataAPI calls.
+
+    Every thread gets its own requests.Session, all sessions mount the
+    same HTTPAdapter, so connections are reused across calls and threads
+    while at most pool_size of them are open at a time.'''
+
+    def __init__(self, pool_size: int = 10, timeout: float = None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.adapter = HTTPAdapter(pool_connections=1,
+                                   pool_maxsize=pool_size,
+                                   pool_block=True)
+        self._local = local()
+        self._sessions: list = []
+        self._lock = Lock()
+
+    def session(self) -> r.Session:
+        '''Return the session of current thread.'''
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = r.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                    'Connection': 'keep-alive'})
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def post(self, url: str, body: dict) -> r.Response:
+        return self.session().post(url, data=json.dumps(body),
+                                   timeout=self.timeout)
+
+    def close(self):
+        '''Close all sessions and pooled connections.'''
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+        self.adapter.close()
+        self._local = local()
+
+
 class JQDataAPI:
     __URL__ = 'https://dataapi.joinquant.com/apis'
     __TOKEN__ = ''
+    __CREDENTIAL__ = None
+    __TRANSPORT__ = HTTPTransport()
+    __AUTH_LOCK__ = Lock()
 
     __C_TYPE = (
         'get_security_info',
@@ -51,6 +110,33 @@ class JQDataAPI:
             return func(*args, **kwargs)
         return inner
     # ----------Utils----------
+    @classmethod
+    def configure(cls, pool_size: int = 10, timeout: float = None, url: str = None):
+        '''Replace the shared HTTP transport, optionally point to another url.'''
+        old = cls.__TRANSPORT__
+        cls.__TRANSPORT__ = HTTPTransport(pool_size, timeout)
+        old.close()
+        if url is not None:
+            cls.__URL__ = url
+
+    @classmethod
+    def _post(cls, body: dict) -> r.Response:
+        '''Post body, get a new token once if the one in body expired.
+
+        Raise QuotaExhaustedError when the daily quota is used up.'''
+        response = cls.__TRANSPORT__.post(cls.__URL__, body)
+        if response.text.startswith('error') and TOKEN_EXPIRED in response.text \
+                and 'token' in body and cls.__CREDENTIAL__ is not None:
+            with cls.__AUTH_LOCK__:
+                # Another thread may have refreshed it already
+                if cls.__TOKEN__ == body['token']:
+                    cls.auth(*cls.__CREDENTIAL__)
+            body = dict(body, token=cls.__TOKEN__)
+            response = cls.__TRANSPORT__.post(cls.__URL__, body)
+        if response.text.startswith('error') and QUOTA_EXHAUSTED in response.text:
+            raise QuotaExhaustedError(response.text)
+        return response
+
     @classmethod
     def auth(cls, user, password):
         body = {
@@ -58,8 +144,9 @@ class JQDataAPI:
             "mob": user,
             "pwd": password,
         }
-        response = r.post(cls.__URL__, data=json.dumps(body))
+        response = cls._post(body)
         cls.__TOKEN__ = response.text
+        cls.__CREDENTIAL__ = (user, password)
 
     @classmethod
     def get_query_count(cls):
@@ -67,7 +154,7 @@ class JQDataAPI:
             "method": "get_query_count",
             "token": cls.__TOKEN__
         }
-        response = r.post(cls.__URL__, data=json.dumps(body))
+        response = cls._post(body)
         return response.text
     # ----------Generic Dataloaders----------
     @_ensure_auth
@@ -78,7 +165,7 @@ class JQDataAPI:
                 "token": self.__TOKEN__,
                 'code': code,
             }
-            response = r.post(self.__URL__, data=json.dumps(body))
+            response = self._post(body)
             df = pd.read_csv(StringIO(response.text))
             return df
         return func
@@ -94,7 +181,7 @@ class JQDataAPI:
                 'code': code,
                 'date': d,
             }
-            response = r.post(self.__URL__, data=json.dumps(body))
+            response = self._post(body)
             df = pd.read_csv(StringIO(response.text))
             return df
         return func
@@ -110,7 +197,7 @@ class JQDataAPI:
                 'code': code,
                 'date': d,
             }
-            response = r.post(self.__URL__, data=json.dumps(body))
+            response = self._post(body)
             return response.text.split('\n')
         return func
 
@@ -128,7 +215,7 @@ class JQDataAPI:
                 'date': s,
                 'enddate': e
             }
-            response = r.post(self.__URL__, data=json.dumps(body))
+            response = self._post(body)
             df = pd.read_csv(StringIO(response.text))
             return df
         return func
@@ -159,7 +246,7 @@ class JQDataAPI:
             'end_date': end.strftime('%Y-%m-%d'),
             "fq_ref_date": ""
         }
-        response = r.post(self.__URL__, data=json.dumps(body))
+        response = self._post(body)
         df = pd.read_csv(StringIO(response.text))
         return df
 
@@ -168,6 +255,11 @@ class JQDataAPI:
                                 table: str,
                                 start: datetime,
                                 end: datetime) -> DataFrame:
+        '''Statements of one code by run_query.
+
+        The conditions only use the #=#, #>=# and #<=# operators documented
+        for run_query, many codes are fetched by concurrent calls instead
+        of one multi-code condition.'''
         cond = "end_date#>=#{s}&end_date#<=#{e}&code#=#{c}&report_type#=#0".format(
             s=start.strftime('%Y-%m-%d'), e=end.strftime('%Y-%m-%d'), c=code)
         body = {
@@ -178,6 +270,6 @@ class JQDataAPI:
             "conditions": cond,
             "count": 1000
         }
-        response = r.post(self.__URL__, data=json.dumps(body))
+        response = self._post(body)
         df = pd.read_csv(StringIO(response.text))
         return df
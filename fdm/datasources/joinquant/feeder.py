@@ -1,23 +1,109 @@
+import json
 from datetime import datetime
 from collections import defaultdict
 
 import pandas as pd
 from pandas import DataFrame
 
-from fdm.utils.decorators import retry, timeout
-
-
-# ------------------------
-# Data cache
-# ------------------------
-jq_cache: defaultdict = defaultdict(DataFrame)
+from fdm.utils.cache import download_cache
+from fdm.utils.config import config
+from fdm.utils.decorators import retry, timeout, frame_feeder
+
+
+def _format_price(df: DataFrame, code: str) -> DataFrame:
+    df['code'] = code
+    df['date'] = pd.to_datetime(df['date'])
+    return df
+
+
+def _format_fs(df: DataFrame) -> DataFrame:
+    for date_type in ('report_date', 'pub_date', 'start_date', 'end_date'):
+        df[date_type] = pd.to_datetime(df[date_type])
+    return df.rename(columns={'report_date': 'date'})
+
+
+def _async_api():
+    from .aio import AsyncJQDataAPI
+    setting = config['JQData']['DBSetting']
+    return AsyncJQDataAPI(setting.get('prefetch_concurrency', 8),
+                          setting.get('quota_reserve', 10000))
+
+
+def _report_skipped(skipped: set):
+    if len(skipped) != 0:
+        print('JQData quota reached reserve, {0} codes skipped.'.format(
+            len(skipped)))
+
+
+def _missing_gaps(params: list, gen_key) -> dict:
+    '''Return {(start, end): {code: None}} of gaps not in download_cache yet.'''
+    groups: defaultdict = defaultdict(dict)
+    for code, field, bubbles, gaps in params:
+        for gap in gaps:
+            start, end = gap.to_actualrange()
+            key = gen_key(code, start, end)
+            if key not in download_cache:
+                groups[start, end][code] = None
+    return groups
+
+
+def _prefetch_price(params: list) -> list:
+    '''Download price of every gap concurrently into download_cache.
+
+    get_price_period takes a single code, so one request per code and gap.
+    Return params without codes skipped because of quota, failed downloads
+    are left to the feeder itself.'''
+    from .api import QuotaExhaustedError
+    groups = _missing_gaps(
+        params, lambda code, start, end: ('JQData', 'get_price', code, start, end))
+    jobs = [(code, start, end) for (start, end), codes in groups.items()
+            for code in codes]
+    if len(jobs) == 0:
+        return params
+    skipped = set()
+    for job, res in zip(jobs, _async_api().run('get_price_period', jobs)):
+        code, start, end = job
+        if isinstance(res, QuotaExhaustedError):
+            skipped.add(code)
+        elif not isinstance(res, Exception):
+            download_cache.put(('JQData', 'get_price', code, start, end),
+                               _format_price(res, code))
+    _report_skipped(skipped)
+    return [p for p in params if p[0] not in skipped]
+
+
+def _prefetch_fs(table: str, params: list) -> list:
+    '''Download statements of every gap concurrently into download_cache.
+
+    run_query is sent with a single code condition, so one request per
+    code and gap, batched on our side by running them concurrently.
+    Return params without codes skipped because of quota, failed downloads
+    are left to the feeder itself.'''
+    from .api import QuotaExhaustedError
+    groups = _missing_gaps(
+        params, lambda code, start, end: ('JQData', 'FS', table, code, start, end))
+    jobs = [(code, table, start, end) for (start, end), codes in groups.items()
+            for code in codes]
+    if len(jobs) == 0:
+        return params
+    skipped = set()
+    for job, res in zip(jobs, _async_api().run('get_financial_statement', jobs)):
+        code, _, start, end = job
+        if isinstance(res, QuotaExhaustedError):
+            skipped.add(code)
+        elif not isinstance(res, Exception) and 'code' in res.columns:
+            download_cache.put(('JQData', 'FS', table, code, start, end),
+                               _format_fs(res))
+    _report_skipped(skipped)
+    return [p for p in params if p[0] not in skipped]
 
 # ------------------------
 # Feeders
 # ------------------------
 
 
-def price(cls, code: str, field: str, start: datetime, end: datetime):
+@frame_feeder
+def price(cls, code: str, fields: list, start: datetime, end: datetime):
     @retry(10)
     def downloader(code, start, end):
         from .api import JQDataAPI as jq
@@ -26,29 +112,23 @@ def price(cls, code: str, field: str, start: datetime, end: datetime):
             start,
             end
         )
-        df['code'] = code
-        df['date'] = pd.to_datetime(df['date'])
-        return df
-
-    # If jq_cache don't have the data then download it
-    if len(jq_cache['get_price',  code, start, end].columns) == 0:
-        jq_cache['get_price', code, start, end] = downloader(code, start, end)
-    # Get result
-    data = jq_cache['get_price', code, start, end]
-    res = data[['code', 'date', field]].copy()
-    # Remove returned data
-    del data[field]
-    # delete from cache if all data has been returned
-    # only [code, date] left in the sheet
-    if data.shape[1] == 2:
-        del jq_cache['get_price', code, start, end]
-    return res
+        return _format_price(df, code)
+
+    # Use prefetched data if any
+    data = download_cache.pop(('JQData', 'get_price', code, start, end))
+    if data is None:
+        data = downloader(code, start, end)
+    return data[['code', 'date'] + fields]
+
+
+price.prefetch = _prefetch_price
 
 # ---------Financial Statement----------
 
 
-def FS_temp(method_name, min_count):
-    def func(cls, code: str, field: str, start: datetime, end: datetime):
+def FS_temp(method_name):
+    @frame_feeder
+    def func(cls, code: str, fields: list, start: datetime, end: datetime):
         @retry(10)
         def downloader(code, table, start, end):
             from .api import JQDataAPI as jq
@@ -58,42 +138,100 @@ def FS_temp(method_name, min_count):
                 start,
                 end
             )
-            for date_type in ('report_date', 'pub_date', 'start_date', 'end_date'):
-                df[date_type] = pd.to_datetime(df[date_type])
-            return df.rename(columns={'report_date': 'date'})
-
-        # If jq_cache don't have the data then download it
-        if len(jq_cache['FS', method_name, code, start, end].columns) == 0:
-            jq_cache['FS', method_name, code, start, end] = downloader(
-                code, method_name, start, end)
-        # Get result
-        data = jq_cache['FS', method_name, code, start, end]
-        res = data[['code', 'date', field]].copy()
-        # Remove returned data
-        del data[field]
-        # delete from cache if all data has been returned
-        # only useless info left in the sheet
-        if data.shape[1] == min_count:
-            del jq_cache['FS', method_name, code, start, end]
-
-        return res
+            return _format_fs(df)
+
+        # Use prefetched data if any
+        data = download_cache.pop(('JQData', 'FS', method_name, code, start, end))
+        if data is None:
+            data = downloader(code, method_name, start, end)
+        return data[['code', 'date'] + fields]
+
+    def prefetch(params: list) -> list:
+        return _prefetch_fs(method_name, params)
+
+    func.prefetch = prefetch
     return func
 
 # -----------sector constituents-----------
 
 
+# Business days between two sampled dates of constituents
+CONSTITUENTS_STEP = 20
+
+
 def constituents(cls, code: str, field: str, start: datetime, end: datetime) -> DataFrame:
+    '''Download membership of a sector as change events.
+
+    Membership is sampled every CONSTITUENTS_STEP business days, intervals
+    whose two ends differ are bisected down to the day of change. Each row
+    holds a JSON event {"added": [...], "removed": [...]}, the first row of
+    a download is a full snapshot marked with "reset" and the last business
+    day always has a row, so the whole range is recorded as downloaded.'''
     from .api import JQDataAPI as jq
 
-    def get_data():
-        dates = pd.date_range(start, end, freq='B')
-        for date in (d.to_pydatetime() for d in dates):
-            v = jq().get_industry_stocks(code, date)
-            res = {
-                'code': code,
-                'date': date,
-                field: ',,'.join(v)
-            }
-            yield res
-
-    return DataFrame(get_data())
+    dates = [d.to_pydatetime() for d in pd.date_range(start, end, freq='B')]
+    if len(dates) == 0:
+        return DataFrame(columns=['code', 'date', field])
+    members: dict = {}
+
+    def get_members(i) -> frozenset:
+        if i not in members:
+            v = jq().get_industry_stocks(code, dates[i])
+            members[i] = frozenset(c for c in v if c != '')
+        return members[i]
+
+    def find_changes(lo, hi):
+        '''Yield indexes in (lo, hi] where membership differs from the day before.'''
+        if get_members(lo) == get_members(hi):
+            return
+        if hi - lo == 1:
+            yield hi
+            return
+        mid = (lo + hi) // 2
+        yield from find_changes(lo, mid)
+        yield from find_changes(mid, hi)
+
+    def event(added, removed, reset=False) -> str:
+        doc = {'added': sorted(added), 'removed': sorted(removed)}
+        if reset:
+            doc['reset'] = True
+        return json.dumps(doc)
+
+    last = len(dates) - 1
+    samples = list(range(0, last, CONSTITUENTS_STEP)) + [last]
+    rows = [(0, event(get_members(0), (), True))]
+    for lo, hi in zip(samples[:-1], samples[1:]):
+        for i in find_changes(lo, hi):
+            rows.append((i, event(get_members(i) - get_members(i - 1),
+                                  get_members(i - 1) - get_members(i))))
+    if rows[-1][0] != last:
+        rows.append((last, event((), ())))
+
+    return DataFrame({'code': code,
+                      'date': [dates[i] for i, _ in rows],
+                      field: [e for _, e in rows]})
+
+
+def parse_constituents(value: str) -> dict:
+    '''Return the event held by a stored constituents value.
+
+    Rows written before change events hold the full membership joined by
+    ',,' and are read as a reset.'''
+    if value.startswith('{'):
+        return json.loads(value)
+    return {'added': [c for c in value.split(',,') if c != ''],
+            'removed': [], 'reset': True}
+
+
+def replay_constituents(events, members=frozenset()) -> frozenset:
+    '''Rebuild membership from stored events in date order, starting from members.'''
+    res: set = set(members)
+    for e in events:
+        if not isinstance(e, str):
+            continue
+        doc = parse_constituents(e)
+        if doc.get('reset', False):
+            res = set(doc['added'])
+        else:
+            res = (res - set(doc['removed'])) | set(doc['added'])
+    return frozenset(res)
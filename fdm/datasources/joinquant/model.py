@@ -10,7 +10,7 @@ from fdm.datasources.metaclass import (_CollectionBase,
                                        _DbBase,
                                        _DynCollectionBase)
 
-from .feeder import price, FS_temp, constituents
+from .feeder import price, FS_temp, constituents, replay_constituents
 from .fields import *
 
 # ----------------------------
@@ -105,43 +105,84 @@ class Constituents(_DynCollectionBase):
               startdate,
               enddate,
               ):
-        res = super().query(codes=codes,
-                            fields='CONSTITUENTS',
-                            startdate=startdate,
-                            enddate=enddate,
-                            skip_update=True)
+        '''Return members of every business day joined by ',,', one column per code.
+
+        Days before the first or after the last download of a code are NaN.'''
+        codes, _, startdate, enddate = self.convert_params(
+            codes, [], startdate, enddate)
+        # Read up to the last download to know which days it covers
+        events = self.events(codes, datetime(1990, 1, 1),
+                             max(enddate, datetime.now()))
+        if events.empty:
+            return DataFrame()
+        res = DataFrame(
+            {'date': pd.date_range(startdate, enddate, freq='B')})
+        events = events.sort_values('date')
+        for code in codes:
+            column = code.upper()
+            if column not in events.columns:
+                continue
+            stored = events[['date', column]].dropna()
+            members = []
+            current = frozenset()
+            for e in stored[column]:
+                current = replay_constituents([e], current)
+                members.append(',,'.join(sorted(current)))
+            s = pd.Series(members, index=stored['date'].values)
+            s = s.reindex(res['date'].values, method='ffill')
+            # Nothing known after the last download
+            s[res['date'].values > stored['date'].max()] = None
+            res[column] = s.values
         return res
 
+    def events(self, codes, startdate, enddate) -> DataFrame:
+        '''Return the stored JSON change events, one column per code.'''
+        return super().query(codes=codes,
+                             fields='CONSTITUENTS',
+                             startdate=startdate,
+                             enddate=enddate,
+                             skip_update=True)
+
+    def members(self, code, date) -> frozenset:
+        '''Rebuild the member set of sector code on date from stored events.'''
+        date = date if not isinstance(
+            date, str) else datetime.strptime(date, '%Y-%m-%d')
+        df = self.events(code, datetime(1990, 1, 1), date)
+        if df.empty or code.upper() not in df.columns:
+            return frozenset()
+        df = df.sort_values('date')
+        return replay_constituents(df[code.upper()])
+
 # ----------------------------
 # Financial Statements
 # ----------------------------
 
 
 class Income(_Template):
-    feeder_func = FS_temp('STK_INCOME_STATEMENT', 11)
+    feeder_func = FS_temp('STK_INCOME_STATEMENT')
     fields = fs_fields['STK_INCOME_STATEMENT']
 
 
 class CashFlow(_Template):
-    feeder_func = FS_temp('STK_CASHFLOW_STATEMENT', 11)
+    feeder_func = FS_temp('STK_CASHFLOW_STATEMENT')
     fields = fs_fields['STK_CASHFLOW_STATEMENT']
 
 
 class Balance(_Template):
-    feeder_func = FS_temp('STK_BALANCE_SHEET', 11)
+    feeder_func = FS_temp('STK_BALANCE_SHEET')
     fields = fs_fields['STK_BALANCE_SHEET']
 
 
 class FinIncome(_Template):
-    feeder_func = FS_temp('FINANCE_INCOME_STATEMENT', 11)
+    feeder_func = FS_temp('FINANCE_INCOME_STATEMENT')
     fields = fs_fields['FINANCE_INCOME_STATEMENT']
 
 
 class FinCashFlow(_Template):
-    feeder_func = FS_temp('FINANCE_CASHFLOW_STATEMENT', 11)
+    feeder_func = FS_temp('FINANCE_CASHFLOW_STATEMENT')
     fields = fs_fields['FINANCE_CASHFLOW_STATEMENT']
 
 
 class FinBalance(_Template):
-    feeder_func = FS_temp('FINANCE_BALANCE_SHEET', 11)
+    feeder_func = FS_temp('FINANCE_BALANCE_SHEET')
     fields = fs_fields['FINANCE_BALANCE_SHEET']
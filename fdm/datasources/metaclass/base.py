@@ -8,7 +8,9 @@ from pymongo import MongoClient
 
 from fdm.utils import client, config
 from fdm.utils.test import test_feeder_func
-from .interface import ColInterface, StaColInterface
+from .interface import ColInterface, StaColInterface, PackedStaColInterface, rechunk
+from .mirror import ParquetMirror
+from .dump import dump_partitions
 
 
 class _CollectionBase:
@@ -16,35 +18,61 @@ class _CollectionBase:
 
     def __init__(self, col: Collection, setting: dict):
         self.interface = ColInterface(col, setting)
+        mirror = config.get('mirror', {})
+        if mirror.get('path'):
+            self.mirror = ParquetMirror(self.interface, mirror['path'],
+                                        mirror.get('code_buckets', 0),
+                                        mirror.get('fresh_ttl', 60))
+        else:
+            self.mirror = None
 
     def last_record_date(self) -> Optional[datetime]:
         return self.interface.lastdate()
 
+    def sync_mirror(self, full=False):
+        '''Export new records to the local Parquet mirror.'''
+        if self.mirror is None:
+            raise KeyError('Unexpected mirror setting: set mirror path in config first')
+        return self.mirror.sync(full)
+
     def query(self, code_list_or_str=None, date=None,
               startdate: datetime = None, enddate: datetime = None,
-              freq='B', fields: list = None, fillna=None) -> DataFrame:
+              freq='B', fields: list = None, fillna=None,
+              workers: int = None, engine: str = None, stream=False) -> DataFrame:
+        # Plain date range queries are served by the mirror if up to date
+        if (self.mirror is not None and date is None and freq in ('B', 'D')
+                and not stream and self.mirror.is_fresh()):
+            return self.mirror.read(code_list_or_str, startdate, enddate, fields)
         df = self.interface.query(code_list_or_str,
                                   date,
                                   startdate,
                                   enddate,
                                   freq,
                                   fields,
-                                  fillna)
+                                  fillna,
+                                  workers,
+                                  engine,
+                                  stream)
         return df
 
-    def batch_dump(self, batch_size=2000):
-        '''Dump all records to a df. Not work for sub collection'''
-        i = 0
-        l = list()
-        for doc in self.interface.col.find():
-            l.append(doc)
-            i += 1
-            if i == batch_size:
-                df = DataFrame(l)
-                del df['_id']
-                yield df
-                l = list()
-                i = 0
+    def batch_dump(self, batch_size=2000, path: str = None, file_format='csv',
+                   workers=1, engine: str = None):
+        '''Dump all records year by year.
+
+        Without path return a generator of DataFrames of batch_size records
+        (the last one holding the rest), sorted by date.
+        With path write every year sub collection to <path>/<year>.<file_format>
+        (csv or parquet) on `workers` threads and return the files written.
+        '''
+        def read(year):
+            return self.interface.iter_query(startdate=datetime(int(year), 1, 1),
+                                             enddate=datetime(int(year), 12, 31),
+                                             chunk_size=batch_size, engine=engine)
+
+        years = self.interface.list_subcollection_names()
+        if path is None:
+            return rechunk((df for year in years for df in read(year)), batch_size)
+        return dump_partitions(years, read, path, file_format, workers)
 
     def get_client(self) -> MongoClient:
         return self.interface.get_client()
@@ -55,7 +83,11 @@ class _DynCollectionBase:
     feeder_func = test_feeder_func
 
     def __init__(self, col: Collection, setting: dict):
-        self.interface = StaColInterface(col, self.feeder_func, setting)
+        if setting.get('storage', 'wide') == 'packed':
+            self.interface = PackedStaColInterface(
+                col, self.feeder_func, setting)
+        else:
+            self.interface = StaColInterface(col, self.feeder_func, setting)
 
     def query(self, codes,
               fields,
@@ -126,6 +158,23 @@ class _DynCollectionBase:
     def create_index(self):
         self.interface.create_indexs()
 
+    def batch_dump(self, batch_size=2000, path: str = None, file_format='csv',
+                   workers=1, engine: str = None):
+        '''Dump all records field by field in long format (date, code, field).
+
+        Without path return a generator of DataFrames of batch_size records,
+        the last chunk of each field holding the rest. With path write every
+        field sub collection to <path>/<field>.<file_format> (csv or parquet)
+        on `workers` threads and return the files written.
+        '''
+        def read(field):
+            return self.interface.iter_field(field, batch_size, engine)
+
+        fields = self.interface.list_subcollection_names()
+        if path is None:
+            return (df for field in fields for df in read(field))
+        return dump_partitions(fields, read, path, file_format, workers)
+
 
 class _DbBase:
     def __init__(self, client: MongoClient = client.client):
@@ -0,0 +1,76 @@
+import os
+
+from fdm.utils.concurrency import imap_ordered
+
+FILE_FORMATS = ('csv', 'parquet')
+
+
+def dump_partitions(partitions: list, read, path: str, file_format: str = 'csv',
+                    workers: int = 1) -> list:
+    '''Write every partition to <path>/<partition>.<file_format>, return paths written.
+
+    read(partition) returns an iterable of DataFrame chunks, chunks are
+    written one at a time so at most one chunk per worker is in memory.
+    Columns of a file are fixed by the first chunk of its partition, files
+    are written under a temporary name and renamed when complete.
+    Parquet needs pyarrow.
+    '''
+    if file_format not in FILE_FORMATS:
+        raise KeyError('Unexpected file format: {0}'.format(file_format))
+    if file_format == 'parquet':
+        import pyarrow  # Fail before touching files if not installed
+    path = os.path.expanduser(path)
+    os.makedirs(path, exist_ok=True)
+
+    def dump(partition):
+        file = os.path.join(path, '{0}.{1}'.format(partition, file_format))
+        tmp = file + '.tmp'
+        if file_format == 'csv':
+            n = _write_csv(read(partition), tmp)
+        else:
+            n = _write_parquet(read(partition), tmp)
+        if n == 0:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None
+        os.replace(tmp, file)
+        print('{0} records dumped to {1}.'.format(n, file))
+        return file
+
+    res = imap_ordered(dump, partitions, workers)
+    return [f for f in res if f is not None]
+
+
+def _write_csv(chunks, file: str) -> int:
+    n = 0
+    columns = None
+    with open(file, 'w', encoding='utf-8', newline='') as f:
+        for df in chunks:
+            if columns is None:
+                columns = list(df.columns)
+            df.reindex(columns=columns).to_csv(
+                f, header=n == 0, index=False)
+            n += len(df)
+    return n
+
+
+def _write_parquet(chunks, file: str) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    n = 0
+    writer = None
+    try:
+        for df in chunks:
+            if writer is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                writer = pq.ParquetWriter(file, table.schema)
+            else:
+                table = pa.Table.from_pandas(
+                    df.reindex(columns=writer.schema.names),
+                    schema=writer.schema, preserve_index=False)
+            writer.write_table(table)
+            n += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n
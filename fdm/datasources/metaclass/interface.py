@@ -1,29 +1,63 @@
 from datetime import datetime, timedelta
 from typing import Optional, Tuple
 from concurrent.futures import ThreadPoolExecutor
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import groupby
+from threading import Lock
 
+import numpy as np
 from pandas import DataFrame
 import pandas as pd
 
 from pymongo.collection import Collection
-from pymongo import MongoClient, UpdateOne
+from pymongo import MongoClient, UpdateOne, ReplaceOne, ReturnDocument
+from bson import Binary
 
 from .manager import Manager
 from fdm.utils.data_structure.bubbles import TimeBubble
-from fdm.utils.tools import del_id, mongodb_name_compliance
+from fdm.utils.tools import del_id, mongodb_name_compliance, prev_date, next_date
+from fdm.utils.columnar import find_columnar, decode_raw_batches
+from fdm.utils.concurrency import imap_ordered, source_limit
 from fdm.utils.exceptions import FeederFunctionError
 
 
+def rechunk(frames, chunk_size: int):
+    '''Regroup an iterable of DataFrames into chunks of exactly chunk_size rows.
+
+    The last chunk holds what is left, empty frames are skipped.'''
+    buf = []
+    n = 0
+    for df in frames:
+        if df.empty:
+            continue
+        buf.append(df)
+        n += len(df)
+        if n >= chunk_size:
+            df = pd.concat(buf, ignore_index=True)
+            for i in range(0, n - n % chunk_size, chunk_size):
+                yield df.iloc[i:i+chunk_size].reset_index(drop=True)
+            buf = [df.iloc[n - n % chunk_size:]] if n % chunk_size else []
+            n = n % chunk_size
+    if n != 0:
+        yield pd.concat(buf, ignore_index=True)
+
+
 class ColInterfaceBase():
+    # Default number of sub collections queried at the same time
+    query_workers = 4
+
     def __init__(self, col: Collection, setting: dict = None):
         self.col = col
+        # Writes made through this object, see _touch
+        self.writes = 0
         if setting is None:
             self.code_name = 'code'
             self.date_name = 'name'
         else:
             self.code_name = setting['code_name']
             self.date_name = setting['date_name']
+            self.query_workers = setting.get(
+                'query_workers', self.query_workers)
 
     # ----------------------------------------
     # Collection info related
@@ -34,7 +68,8 @@ class ColInterfaceBase():
         if include_property:
             property_name = ()
         else:
-            property_name = ('__FieldStatus', '__FieldStore', '__Log')
+            property_name = ('__FieldStatus', '__FieldStore', '__Log',
+                             '__Progress', '__State')
         db = self.col.database
         res = []
         for name in db.list_collection_names():
@@ -68,6 +103,49 @@ class ColInterfaceBase():
         '''Return MonogClient.'''
         return self.col.database.client
 
+    def _find_frame(self, subcol: Collection, filter_doc: dict,
+                    fields: Optional[list] = None, engine: Optional[str] = None,
+                    sort: Optional[list] = None) -> DataFrame:
+        '''Run a find on a sub collection and return result as DataFrame.
+
+        engine: [None, 'columnar'] None builds the DataFrame from documents,
+            'columnar' decodes BSON batches straight into per field arrays.
+        sort: list of (key, direction) pairs to sort the cursor by.
+        '''
+        if engine is None:
+            cursor = subcol.find(filter_doc, projection=fields)
+            if sort is not None:
+                cursor = cursor.sort(sort)
+            return DataFrame(cursor)
+        elif engine == 'columnar':
+            return find_columnar(subcol, filter_doc, fields, sort)
+        else:
+            raise KeyError('Unexpected query engine: {0}'.format(engine))
+
+    def _iter_frames(self, subcol: Collection, filter_doc: dict, projection: dict,
+                     sort: list, chunk_size: int, engine: Optional[str] = None):
+        '''Run a find on a sub collection, yield DataFrames of at most chunk_size records.'''
+        if engine is None:
+            cursor = subcol.find(filter_doc, projection=projection).sort(
+                sort).batch_size(chunk_size)
+            chunk = []
+            for doc in cursor:
+                chunk.append(doc)
+                if len(chunk) == chunk_size:
+                    yield DataFrame(chunk)
+                    chunk = []
+            if chunk:  # if not empty
+                yield DataFrame(chunk)
+        elif engine == 'columnar':
+            cursor = subcol.find_raw_batches(
+                filter_doc, projection=projection, sort=sort, batch_size=chunk_size)
+            for batch in cursor:
+                df = decode_raw_batches([batch])
+                if not df.empty:
+                    yield df
+        else:
+            raise KeyError('Unexpected query engine: {0}'.format(engine))
+
     # ----------------------------------------
     # Collection level management
     # ----------------------------------------
@@ -75,10 +153,34 @@ class ColInterfaceBase():
         '''Drop all sub collections.'''
         self.col.drop()
         subcols = self.list_subcollection_names()
+        self._touch(subcols)
         for subcol in subcols:
             self.col[subcol].drop()
         return 0
 
+    def _touch(self, subcols: list):
+        '''Record a write into sub collections in __State.
+
+        The version counts writes, touched keeps the version of the last
+        write into each sub collection, so readers such as ParquetMirror
+        know what changed since they last looked.'''
+        self.writes += 1
+        state = self.col['__State'].find_one_and_update(
+            {'_id': 'writes'}, {'$inc': {'version': 1}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        if len(subcols) != 0:
+            self.col['__State'].update_one(
+                {'_id': 'writes'},
+                {'$max': {'touched.' + str(s): state['version'] for s in subcols}})
+
+    def write_state(self) -> dict:
+        '''Return {'version': int, 'touched': {sub collection: version}}.'''
+        state = self.col['__State'].find_one({'_id': 'writes'})
+        if state is None:
+            return {'version': 0, 'touched': {}}
+        state.setdefault('touched', {})
+        return state
+
     def create_indexs(self, indexes: list = None):
         '''Create index for all sub collections.'''
         indexes = [self.code_name,
@@ -107,7 +209,10 @@ class ColInterface(ColInterfaceBase):
               enddate: Optional[datetime] = None,
               freq='B',
               fields: Optional[list] = None,
-              fillna=None):
+              fillna=None,
+              workers: Optional[int] = None,
+              engine: Optional[str] = None,
+              stream: bool = False):
         '''Query data from database.
 
         code_list_or_str: [None, code, List[codes]] when set to None, will query all codes.
@@ -117,55 +222,67 @@ class ColInterface(ColInterfaceBase):
         freq: freq type of pandas date_range
         fields: fields ot return from database
         fillna: [None, 'ffill', 'bfill']
+        workers: number of sub collections queried concurrently, default to query_workers
+        engine: [None, 'columnar'] how documents are decoded into DataFrame
+        stream: return a generator of DataFrame chunks instead, see iter_query
         '''
-        def gen_code_filter(codes) -> dict:
-            '''Generate filter doc base on code or a list of codes'''
-            if codes is None:
-                return {}
-            elif isinstance(codes, str):
-                return {self.code_name: codes}
-            else:
-                return {self.code_name: {'$in': list(codes)}}
+        if stream:
+            return self.iter_query(code_list_or_str, date, startdate, enddate,
+                                   freq, fields, engine=engine)
 
         def query_on_dates(codes, dates, fields) -> DataFrame:
             '''Query data on date or a list of dates.'''
-            q_params = gen_code_filter(codes)
+            q_params = self._gen_code_filter(codes)
             if isinstance(dates, (datetime, pd.Timestamp)):
                 q_params[self.date_name] = dates
                 year = dates.year
-                res = DataFrame(self.col[str(year)].find(
-                    q_params, projection=fields))
+                res = self._find_frame(
+                    self.col[str(year)], q_params, fields, engine)
                 return res
             else:
-                res = DataFrame()
-                for year in {i.year for i in dates}:
-                    q_dates = [i for i in dates if i.year == year]
-                    q_params[self.date_name] = {'$in': q_dates}
-                    df = DataFrame(self.col[str(year)].find(
-                        q_params, projection=fields))
-                    res = res.append(df)
-                return res
+                jobs = []
+                for year in sorted({i.year for i in dates}):
+                    q_doc = q_params.copy()
+                    q_doc[self.date_name] = {
+                        '$in': [i for i in dates if i.year == year]}
+                    jobs.append((year, q_doc))
+                return self._find_by_years(jobs, fields, workers, engine)
 
         def query_on_daterange(codes, start: datetime, end: datetime, fields, freq: str) -> DataFrame:
             '''Query data on given date range and frequency'''
-            q_params = gen_code_filter(codes)
+            q_params = self._gen_code_filter(codes)
             if freq in ('B', 'D'):
-                res = DataFrame()
+                jobs = []
                 for year in range(start.year, end.year+1):
-                    subcol = self.col[str(year)]
-                    q_params[self.date_name] = {
+                    q_doc = q_params.copy()
+                    q_doc[self.date_name] = {
                         '$gte': max(start, datetime(year, 1, 1)),
                         '$lte': min(end, datetime(year, 12, 31))
                     }
-                    cursor = subcol.find(q_params, projection=fields)
-                    df = DataFrame(cursor)
-                    res = res.append(df)
-                return res
+                    jobs.append((year, q_doc))
+                return self._find_by_years(jobs, fields, workers, engine)
             else:
                 daterange = pd.date_range(
                     start=start, end=end, freq=freq, normalize=True)
                 return query_on_dates(codes, daterange, fields)
 
+        def query_on_windows(codes, windows, fields) -> DataFrame:
+            '''Query data on sorted [start, end] windows, one $or filter per year.'''
+            q_params = self._gen_code_filter(codes)
+            by_year: defaultdict = defaultdict(list)
+            for start, end in windows:
+                start, end = start.to_pydatetime(), end.to_pydatetime()
+                for year in range(start.year, end.year+1):
+                    by_year[year].append({self.date_name: {
+                        '$gte': max(start, datetime(year, 1, 1)),
+                        '$lte': min(end, datetime(year, 12, 31))}})
+            jobs = []
+            for year in sorted(by_year):
+                q_doc = q_params.copy()
+                q_doc['$or'] = by_year[year]
+                jobs.append((year, q_doc))
+            return self._find_by_years(jobs, fields, workers, engine)
+
         def deal_nonetype_start_end(start, end) -> Tuple[datetime, datetime]:
             '''Interprete start and end date if is None'''
             subcols = self.list_subcollection_names()
@@ -184,91 +301,94 @@ class ColInterface(ColInterfaceBase):
                 f = list(set(f).union((self.code_name, self.date_name)))
             return f
 
-        def fill_nan(df: DataFrame, freq, method) -> DataFrame:
-            def iter_na_list_by_date():
-                if not df.empty:
-                    def _(s: pd.Series):
-                        isna = s.isna()
-                        isna[isna == True]
-                        res = isna[isna == True].index
-                        return set(res)
-
-                    pdf = df.pivot(index=date_name, columns=code_name,
-                                   values=code_name)
-                    pdf = pdf.reindex(pd.date_range(
-                        startdate, enddate, freq=freq))
-                    for date, value in pdf.iterrows():
-                        na_list = _(value)
-                        if len(na_list) != 0:
-                            yield date, na_list
-                else:
-                    if code_list_or_str is None:
-                        index = pd.date_range(startdate, enddate, freq=freq)
-                        for date in index:
-                            yield date, None
-                    else:
-                        index = pd.date_range(startdate, enddate, freq=freq)
-                        na_list = set(code_list_or_str)
-                        for date in index:
-                            yield date, na_list
-
-            def cutoff_methods(key):
-                def f_cutoff(date):
-                    return pd.date_range(end=date, periods=2, freq=freq)[0]
-
-                def b_cutoff(date):
-                    return pd.date_range(start=date, periods=2, freq=freq)[-1]
-
-                keyring = {
-                    'ffill': f_cutoff,
-                    'bfill': b_cutoff, }
-                try:
-                    return keyring[key]
-                except:
-                    raise KeyError('Unexpected fillna method: {0}'.format(key))
-
-            def fill_data(df, date, cutoff, codes):
-                if codes is None:
-                    codes = self.list_code_names()
-                if method == 'ffill':
-                    try:
-                        near_date = self.get_nearest_date(codes, date, True)
-                        if near_date > cutoff:
-                            res = query_on_dates(codes, near_date, fields)
-                            res[date_name] = date
-                            df = df.append(res)
-                            filled_codes = set(res[code_name])
-                            unfilled_codes = codes - filled_codes
-                            if len(unfilled_codes) > 0:
-                                df = fill_data(
-                                    df, date, cutoff, unfilled_codes)
-                    except KeyError:
-                        # Solve KeyError induced by self.get_nearest_date if no value return
-                        pass
-                elif method == 'bfill':
-                    try:
-                        near_date = self.get_nearest_date(codes, date, False)
-                        if near_date < cutoff:
-                            res = query_on_dates(codes, near_date, fields)
-                            res[date_name] = date
-                            df = df.append(res)
-                            filled_codes = set(res[code_name])
-                            unfilled_codes = codes - filled_codes
-                            if len(unfilled_codes) > 0:
-                                df = fill_data(
-                                    df, date, cutoff, unfilled_codes)
-                    except KeyError:
-                        pass
-                return df
+        def fill_nan(df: DataFrame, start, end, freq, method) -> DataFrame:
+            '''Fill (date, code) pairs without record by an as-of merge.
 
-            cutoff_method = cutoff_methods(method)
+            ffill takes the latest record after the previous date, bfill the
+            earliest record before the next date. Only records between the
+            dates that miss a code and their cutoff are read.'''
+            if method not in ('ffill', 'bfill'):
+                raise KeyError('Unexpected fillna method: {0}'.format(method))
             date_name = self.date_name
             code_name = self.code_name
 
-            for date, codes in iter_na_list_by_date():
-                cutoff = cutoff_method(date)
-                df = fill_data(df, date, cutoff, codes)
-            return df
+            dates = pd.date_range(start, end, freq=freq, normalize=True)
+            if len(dates) == 0:
+                return df
+            prevs = dates[:-1].insert(0, prev_date(dates[0], freq))
+            nexts = dates[1:].append(
+                pd.DatetimeIndex([next_date(dates[-1], freq)]))
+
+            # (date, code) pairs to fill
+            if not df.empty:
+                codes = df[code_name].unique()
+            elif code_list_or_str is None:
+                codes = None
+            elif isinstance(code_list_or_str, str):
+                codes = [code_list_or_str]
+            else:
+                codes = list(code_list_or_str)
+
+            if codes is not None:
+                grid = pd.MultiIndex.from_product(
+                    [dates, codes], names=[date_name, code_name])
+                if not df.empty:
+                    exist = pd.MultiIndex.from_frame(
+                        df[[date_name, code_name]])
+                    grid = grid[~grid.isin(exist)]
+                if len(grid) == 0:
+                    return df
+                missing = grid.to_frame(index=False)
+                miss_dates = dates[dates.isin(missing[date_name])]
+                q_codes = list(missing[code_name].unique())
+            else:
+                miss_dates = dates
+                q_codes = None
+
+            # Only read between each missing date and its cutoff
+            pos = dates.get_indexer(miss_dates)
+            if method == 'ffill':
+                starts = prevs[pos] + timedelta(1)
+                ends = miss_dates - timedelta(1)
+            else:
+                starts = miss_dates + timedelta(1)
+                ends = nexts[pos] - timedelta(1)
+            windows = []
+            for s, e in zip(starts[starts <= ends], ends[starts <= ends]):
+                if windows and s <= windows[-1][1] + timedelta(1):
+                    windows[-1][1] = max(windows[-1][1], e)
+                else:
+                    windows.append([s, e])
+            if len(windows) == 0:
+                return df
+            slab = del_id(query_on_windows(q_codes, windows, fields))
+            if slab.empty:
+                return df
+
+            if codes is None:
+                missing = pd.MultiIndex.from_product(
+                    [dates, slab[code_name].unique()],
+                    names=[date_name, code_name]).to_frame(index=False)
+
+            src_name = '__src_date'
+            slab = slab.rename(columns={date_name: src_name})
+            slab = slab.sort_values(src_name, kind='mergesort')
+            missing = missing.sort_values(date_name, kind='mergesort')
+            filled = pd.merge_asof(missing, slab,
+                                   left_on=date_name, right_on=src_name,
+                                   by=code_name,
+                                   direction='backward' if method == 'ffill' else 'forward')
+
+            # Drop records beyond the cutoff
+            pos = dates.get_indexer(filled[date_name])
+            if method == 'ffill':
+                valid = filled[src_name] > prevs[pos]
+            else:
+                valid = filled[src_name] < nexts[pos]
+            filled = filled[valid.values].drop(columns=src_name)
+            if filled.empty:
+                return df
+            return pd.concat([df, filled], ignore_index=True, sort=False)
 
         fields = ensure_date_code_fields(fields)
         if not date is None:
@@ -281,7 +401,101 @@ class ColInterface(ColInterfaceBase):
             if fillna is None or freq in ('B', 'D'):
                 return del_id(res)
             else:
-                return del_id(fill_nan(res, freq, fillna))
+                return del_id(fill_nan(del_id(res), start, end, freq, fillna))
+
+    def iter_query(self, code_list_or_str=None,
+                   date=None,
+                   startdate: Optional[datetime] = None,
+                   enddate: Optional[datetime] = None,
+                   freq='B',
+                   fields: Optional[list] = None,
+                   chunk_size: int = 50000,
+                   engine: Optional[str] = None):
+        '''Yield query result as DataFrames of at most chunk_size records.
+
+        Filters are the same as query, without fillna. Sub collections are
+        read one year at a time with cursors sorted by date and batched by
+        chunk_size, so memory use does not grow with the range.
+        '''
+        if fields is not None:
+            projection = {f: 1 for f in set(fields).union(
+                (self.code_name, self.date_name))}
+        else:
+            projection = {}
+        projection['_id'] = 0
+        sort = [(self.date_name, 1)]
+
+        for year, q_doc in self._gen_year_filters(code_list_or_str, date,
+                                                  startdate, enddate, freq):
+            yield from self._iter_frames(self.col[str(year)], q_doc, projection,
+                                         sort, chunk_size, engine)
+
+    def _gen_year_filters(self, codes, date, start, end, freq):
+        '''Yield (year, filter doc) of a query in year order.'''
+        q_params = self._gen_code_filter(codes)
+        if date is None and freq not in ('B', 'D'):
+            subcols = self.list_subcollection_names()
+            if len(subcols) == 0:
+                return
+            start = datetime(int(subcols[0]), 1, 1) if start is None else start
+            end = datetime(int(subcols[-1]), 12, 31) if end is None else end
+            date = pd.date_range(start=start, end=end, freq=freq, normalize=True)
+
+        if date is None:
+            for year in self.list_subcollection_names():
+                year = int(year)
+                if (start is not None and year < start.year) or \
+                        (end is not None and year > end.year):
+                    continue
+                q_doc = q_params.copy()
+                date_range = {}
+                if start is not None and start > datetime(year, 1, 1):
+                    date_range['$gte'] = start
+                if end is not None and end < datetime(year, 12, 31):
+                    date_range['$lte'] = end
+                if date_range:
+                    q_doc[self.date_name] = date_range
+                yield year, q_doc
+        elif isinstance(date, (datetime, pd.Timestamp)):
+            q_doc = q_params.copy()
+            q_doc[self.date_name] = date
+            yield date.year, q_doc
+        else:
+            for year in sorted({i.year for i in date}):
+                q_doc = q_params.copy()
+                q_doc[self.date_name] = {
+                    '$in': [i for i in date if i.year == year]}
+                yield year, q_doc
+
+    def _gen_code_filter(self, codes) -> dict:
+        '''Generate filter doc base on code or a list of codes'''
+        if codes is None:
+            return {}
+        elif isinstance(codes, str):
+            return {self.code_name: codes}
+        else:
+            return {self.code_name: {'$in': list(codes)}}
+
+    def _find_by_years(self, jobs, fields, workers=None, engine=None) -> DataFrame:
+        '''Run a find on each (year, filter) job and concat results in year order.
+
+        Jobs are fanned out to a bounded thread pool sharing the MongoClient.'''
+        def find(job) -> DataFrame:
+            year, q_doc = job
+            return self._find_frame(self.col[str(year)], q_doc, fields, engine)
+
+        jobs = list(jobs)
+        workers = self.query_workers if workers is None else workers
+        if workers <= 1 or len(jobs) <= 1:
+            frames = [find(job) for job in jobs]
+        else:
+            with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as exe:
+                frames = list(exe.map(find, jobs))
+
+        frames = [df for df in frames if not df.empty]
+        if len(frames) == 0:
+            return DataFrame()
+        return pd.concat(frames, ignore_index=True, sort=False)
 
     def rolling_query(self,
                       window: int,
@@ -291,42 +505,129 @@ class ColInterface(ColInterfaceBase):
                       fields: list = None,
                       freq='B',
                       ascending=True,
-                      fillna='ffill') -> DataFrame:
-        '''Get a rolling window from collection.'''
+                      fillna='ffill',
+                      engine: Optional[str] = None) -> DataFrame:
+        '''Get a rolling window from collection.
+
+        Every date of the date range closes one period (previous date, date],
+        a window holds the last `window` periods that have records.
+        The whole span is read once with one date sorted cursor per year,
+        following the direction of iteration, and windows are yielded as
+        soon as the periods they hold are complete.
+        '''
+        date_name = self.date_name
+        code_name = self.code_name
+        one_day = timedelta(1)
 
         if startdate is None:
             startdate = self.firstdate()
         if enddate is None:
             enddate = self.lastdate()
 
-        drange = pd.date_range(start=startdate,
-                               end=enddate,
-                               freq=freq,
-                               normalize=True).sort_values(ascending=ascending)
-
-        result = DataFrame()
-        records_count = []
+        ends = pd.date_range(start=startdate,
+                             end=enddate,
+                             freq=freq,
+                             normalize=True)
+        if len(ends) == 0:
+            return
+        # Period i covers [starts[i], ends[i]]
+        starts = ends[:-1].insert(0, prev_date(ends[0], freq)) + one_day
+
+        # Same as query, records are only filled when querying on dates
+        on_dates = freq not in ('B', 'D')
+        fillna = fillna if on_dates else None
+        if fillna == 'bfill':
+            # Back fill looks ahead until the next date
+            highs = ends[1:].append(
+                pd.DatetimeIndex([next_date(ends[-1], freq)]))
+        elif fillna in (None, 'ffill'):
+            highs = ends
+        else:
+            raise KeyError('Unexpected fillna method: {0}'.format(fillna))
 
-        def gen_start_end(date):
-            start = pd.date_range(end=date, periods=2, freq=freq)[
-                0]+timedelta(1)
-            return start.to_pydatetime(), date.to_pydatetime()
+        if fields is not None:
+            fields = list(set(fields).union((code_name, date_name)))
 
-        for start, end in (gen_start_end(date) for date in drange):
-            df = self.query(code_list_or_str,
-                            startdate=start,
-                            enddate=end,
-                            freq=freq,
-                            fields=fields,
-                            fillna=fillna)
+        def read_year(year) -> DataFrame:
+            q_doc = self._gen_code_filter(code_list_or_str)
+            if on_dates and fillna is None:
+                q_doc[date_name] = {'$in': [
+                    d.to_pydatetime() for d in ends if d.year == year]}
+            else:
+                q_doc[date_name] = {
+                    '$gte': max(starts[0].to_pydatetime(), datetime(year, 1, 1)),
+                    '$lt': min(highs[-1].to_pydatetime() + one_day,
+                               datetime(year + 1, 1, 1))
+                }
+            df = self._find_frame(self.col[str(year)], q_doc, fields,
+                                  engine, sort=[(date_name, 1)])
+            return del_id(df)
 
-            if not df.empty:
-                result = result.append(df)
-                records_count.append(df.shape[0])
+        def period_frame(i, data: DataFrame, dates) -> DataFrame:
+            def locate(date, side):
+                return dates.searchsorted(date.to_datetime64(), side)
 
-            if len(records_count) == window:
-                yield result
-                result = result.iloc[records_count.pop(0):]
+            if on_dates:
+                df = data.iloc[locate(ends[i], 'left'):locate(ends[i], 'right')]
+            else:
+                df = data.iloc[locate(starts[i], 'left'):locate(ends[i], 'right')]
+
+            if df.empty and fillna == 'ffill':
+                # Latest record of each code within (ends[i-1], ends[i])
+                df = data.iloc[locate(starts[i], 'left'):locate(ends[i], 'left')]
+                df = df.drop_duplicates(code_name, keep='last').copy()
+                df[date_name] = ends[i]
+            elif df.empty and fillna == 'bfill':
+                # Earliest record of each code within (ends[i], ends[i+1])
+                df = data.iloc[locate(ends[i], 'right'):locate(highs[i], 'left')]
+                df = df.drop_duplicates(code_name, keep='first').copy()
+                df[date_name] = ends[i]
+            return df.reset_index(drop=True)
+
+        subcols = set(self.list_subcollection_names())
+        years = range(starts[0].year, highs[-1].year + 1)
+        order = iter(range(len(ends)) if ascending
+                     else range(len(ends) - 1, -1, -1))
+        i = next(order, None)
+
+        buffer = DataFrame()
+        periods = deque(maxlen=window)
+        for year in (years if ascending else reversed(years)):
+            if str(year) in subcols:
+                df = read_year(year)
+                if not df.empty:
+                    chunks = [buffer, df] if ascending else [df, buffer]
+                    buffer = pd.concat(chunks, ignore_index=True, sort=False)
+            dates = buffer[date_name].values if not buffer.empty else None
+
+            # Periods whose span has been fully read, all of them after the last year
+            last_year = year == (years[-1] if ascending else years[0])
+            emitted = None
+            while i is not None:
+                if not last_year:
+                    if ascending and highs[i] >= datetime(year + 1, 1, 1):
+                        break
+                    if not ascending and starts[i] < datetime(year, 1, 1):
+                        break
+                if dates is not None:
+                    df = period_frame(i, buffer, dates)
+                    if not df.empty:
+                        periods.append(df)
+                        if len(periods) == window:
+                            yield pd.concat(periods, sort=False)
+                emitted = i
+                i = next(order, None)
+
+            # Release records no remaining period needs
+            if emitted is not None and dates is not None:
+                if ascending:
+                    k = dates.searchsorted(
+                        ends[emitted].to_datetime64(), 'right')
+                    buffer = buffer.iloc[k:]
+                else:
+                    k = dates.searchsorted(
+                        ends[emitted].to_datetime64(), 'left')
+                    buffer = buffer.iloc[:k]
 
     def insert_many(self, df: DataFrame):
         '''Insert DataFrame into each sub collections accordingly.'''
@@ -337,12 +638,15 @@ class ColInterface(ColInterfaceBase):
             mindate = min(df[date_name])
             maxdate = max(df[date_name])
 
+            years = []
             for year in range(mindate.year, maxdate.year+1):
                 idf = df[(df[date_name] <= datetime(year, 12, 31)) &
                          (df[date_name] >= datetime(year, 1, 1))]
                 record = idf.to_dict('record')
                 if len(record) != 0:
                     self.col[str(year)].insert_many(record)
+                    years.append(year)
+            self._touch(years)
 
             return 0
 
@@ -350,6 +654,14 @@ class ColInterface(ColInterfaceBase):
         '''Delete record given date'''
         col: Collection = self.col[str(date.year)]
         col.delete_many({self.date_name: date})
+        self._touch([date.year])
+
+    def delete_by_code(self, code: str):
+        '''Delete all records of code in every sub collection.'''
+        subcols = self.list_subcollection_names()
+        for subcol in subcols:
+            self.col[subcol].delete_many({self.code_name: code})
+        self._touch(subcols)
 
     # ----------------------------------------
     # Qurey date
@@ -479,7 +791,7 @@ class DynColInterface(ColInterfaceBase):
                 bubbles = bubbles.carve(gap)
                 self.manager.log.remove(code, field, gap)
             self.manager.status[code, field] = bubbles
-        self.manager.log.flush()
+        self.manager.flush()
 
     def _auto_update(self, codes: list,
                      startdate: datetime,
@@ -535,7 +847,7 @@ class DynColInterface(ColInterfaceBase):
         for param in update_params:
             self.manager.log.cache += _work(param)
 
-        self.manager.log.flush()
+        self.manager.flush()
 
     def _convert_codes(self, code_list_or_str) -> list:
         '''Convert codes to deal with multi type.'''
@@ -552,6 +864,27 @@ class DynColInterface(ColInterfaceBase):
         res = res.union({self.code_name, self.date_name})
         return list(res)
 
+    def _feed(self, code: str, fields: list, start: datetime, end: datetime) -> dict:
+        '''Download fields of code, return {field: DataFrame holding field}.
+
+        Feeders marked by frame_feeder return every field in one frame and
+        are called once, other feeders are called once per field.'''
+        if getattr(self.feeder_func, 'frame_feeder', False):
+            df = self.feeder_func(code, fields, start, end)
+            if df is None:
+                raise FeederFunctionError('Feeder returned no data.')
+            return {field: df for field in fields}
+        res = {}
+        for field in fields:
+            df = self.feeder_func(code, field, start, end)
+            if df is None:
+                raise FeederFunctionError('Feeder returned no data.')
+            res[field] = df
+        return res
+
+    def _create_field_index(self, subcol: Collection):
+        subcol.create_index(self.date_name, unique=True)
+
     def _insert(self, df: DataFrame, code, field, bubble):
         '''Insert DataFrame into each sub collections accordingly.'''
         def form_bulk_write(records):
@@ -580,11 +913,20 @@ class DynColInterface(ColInterfaceBase):
 
 class StaColInterface(ColInterfaceBase):
     '''ColInterface that deal with dynamic fields.'''
+    # Default number of codes downloaded at the same time
+    feeder_workers = 1
+    # Number of codes a feeder prefetches at a time
+    prefetch_codes = 50
 
     def __init__(self, col: Collection, feeder_func, setting: dict = None):
         super().__init__(col, setting)
         self.manager = Manager(col)
         self.feeder_func = feeder_func
+        if setting is not None:
+            self.feeder_workers = setting.get(
+                'feeder_workers', self.feeder_workers)
+            self.prefetch_codes = setting.get(
+                'prefetch_codes', self.prefetch_codes)
 
     def query(self, codes: list,
               fields: list,
@@ -592,8 +934,12 @@ class StaColInterface(ColInterfaceBase):
               enddate: datetime,
               force_update=False,
               update_only=False,
-              skip_update=False) -> defaultdict:
-        # Convert string code to list
+              skip_update=False,
+              engine: Optional[str] = None) -> defaultdict:
+        '''Query wide format data of fields, update from feeder if needed.
+
+        engine: [None, 'columnar'] how documents are decoded into DataFrame
+        '''
 
         if force_update:
             # Remove targeted data from database if deemed outdated
@@ -607,16 +953,39 @@ class StaColInterface(ColInterfaceBase):
             codes = mongodb_name_compliance(codes)
             fields = mongodb_name_compliance(fields)
             for field in fields:
-                subcol = self.col[field]
-                q_doc = {
-                    self.date_name: {'$gte': startdate, '$lte': enddate}
-                }
-                v = DataFrame(subcol.find(q_doc, codes + [self.date_name]))
-                df = del_id(v)
+                df = self._read_field(field, codes, startdate, enddate, engine)
                 df.columns = [c.replace('~', '.') for c in df.columns]
                 res[field] = df
         return res
 
+    def _read_field(self, field: str, codes: list, startdate: datetime,
+                    enddate: datetime, engine: Optional[str] = None) -> DataFrame:
+        '''Read wide format data of a field, codes in storage format.'''
+        q_doc = {
+            self.date_name: {'$gte': startdate, '$lte': enddate}
+        }
+        v = self._find_frame(
+            self.col[field], q_doc, codes + [self.date_name], engine)
+        return del_id(v)
+
+    def iter_field(self, field: str, chunk_size: int = 50000,
+                   engine: Optional[str] = None):
+        '''Yield all records of a field sub collection in long format.
+
+        Chunks are DataFrames of exactly chunk_size (date, code, field)
+        records, except the last one, missing values are dropped.'''
+        name = field.replace('~', '.')
+
+        def gen():
+            for df in self._iter_frames(self.col[field], {}, {'_id': 0},
+                                        [(self.date_name, 1)], chunk_size, engine):
+                df = df.melt(id_vars=[self.date_name], var_name=self.code_name,
+                             value_name=name).dropna(subset=[name])
+                df[self.code_name] = df[self.code_name].str.replace('~', '.')
+                yield df
+
+        return rechunk(gen(), chunk_size)
+
     def remove(self, codes: list,
                startdate: datetime,
                enddate: datetime,
@@ -625,21 +994,22 @@ class StaColInterface(ColInterfaceBase):
             codes, fields, startdate, enddate)
 
         for code, field, bubbles, gaps in params:
+            subcol = self.col[mongodb_name_compliance(field)]
             for gap in gaps:
-                filter_doc: dict = {
-                    self.date_name: {'$gte': gap.min,
-                                     '$lt': gap.max},
-                }
-                #subcol = self.col[field.upper().replace('.', '~')]
-                '''r = subcol.update_many(filter_doc,
-                                       {'$unset': {code: ''}},
-                                       upsert=True)
-                assert r.acknowledged'''
+                # Values left in range would outlive the new download
+                self._clear(subcol, mongodb_name_compliance(code),
+                            gap.min, gap.max)
                 # Log operation
                 bubbles = bubbles.carve(gap)
                 self.manager.log.remove(code, field, gap)
             self.manager.status[code, field] = bubbles
-        self.manager.log.flush()
+        self.manager.flush()
+
+    def _clear(self, subcol: Collection, code: str, start: datetime, end: datetime):
+        '''Remove values of code dated in [start, end), code in storage format.'''
+        filter_doc = {self.date_name: {'$gte': start, '$lt': end},
+                      code: {'$exists': True}}
+        subcol.update_many(filter_doc, {'$unset': {code: ''}})
 
     def _auto_update(self, codes: list,
                      startdate: datetime,
@@ -688,9 +1058,10 @@ class StaColInterface(ColInterfaceBase):
             return bubbles
 
         def binding_data(l: DataFrame, r: DataFrame, code: str, field: str) -> DataFrame:
-            if not r.dropna().empty:
+            # r may hold other fields of the same download, or no column at all
+            if field in r.columns and r[field].notna().any():
                 # Convert format
-                r = r.set_index(self.date_name)[[field]]
+                r = r[[self.date_name, field]].set_index(self.date_name)
                 r.columns = [code]
                 try:
                     # Try join the data first
@@ -703,18 +1074,82 @@ class StaColInterface(ColInterfaceBase):
             else:
                 return l
 
+        def gaps_key(gaps) -> tuple:
+            return tuple(tuple(gap.to_actualrange()) for gap in gaps)
+
+        def download(params):
+            '''Run feeder on every gap of every field of one code.
+
+            Fields sharing the same gaps are downloaded together. Return
+            what has been downloaded and the codes and fields failed with
+            the error if any, so that a failure is recorded without
+            stopping other codes.'''
+            res = [(param, []) for param in params]
+            groups: dict = {}
+            for i, (_, _, _, gaps) in enumerate(params):
+                groups.setdefault(gaps_key(gaps), []).append(i)
+            for idx in groups.values():
+                code, _, _, gaps = params[idx[0]]
+                fields = [params[i][1] for i in idx]
+                try:
+                    for gap in gaps:
+                        start, end = gap.to_actualrange()
+                        with limit:
+                            data = self._feed(code, fields, start, end)
+                        for i in idx:
+                            res[i][1].append((gap, data[params[i][1]]))
+                except Exception as e:
+                    return res, ([code], fields, e)
+            return res, None
+
+        def download_codes(params):
+            '''Run a multi code feeder on every gap of one field of many codes.'''
+            res = [(param, []) for param in params]
+            codes = [p[0] for p in params]
+            _, field, _, gaps = params[0]
+            try:
+                for gap in gaps:
+                    start, end = gap.to_actualrange()
+                    with limit:
+                        df = self.feeder_func(codes, field, start, end)
+                    if df is None:
+                        raise FeederFunctionError('Feeder returned no data.')
+                    by_code = dict(iter(df.groupby(self.code_name, sort=False))) \
+                        if not df.empty else {}
+                    for param, done in res:
+                        done.append((gap, by_code.get(param[0], df.iloc[0:0])))
+            except Exception as e:
+                return res, (codes, [field], e)
+            return res, None
+
+        def gen_work(update_params):
+            '''Group update params into the units downloaded by one worker.'''
+            per_call = getattr(self.feeder_func, 'codes_per_call', None)
+            if per_call is None:
+                # Feeders cache downloads by code, keep one code on one worker
+                for _, params in groupby(update_params, key=lambda p: p[0]):
+                    yield download, list(params)
+            else:
+                # Codes of the same field and gaps go into one call
+                groups: dict = {}
+                for param in update_params:
+                    key = (param[1], gaps_key(param[3]))
+                    groups.setdefault(key, []).append(param)
+                for params in groups.values():
+                    for i in range(0, len(params), per_call):
+                        yield download_codes, params[i:i+per_call]
+
         def gen_data_by_batches(update_params, batch_size=500):
             result = defaultdict(DataFrame)
             count = 0
-            try:
-                for param in update_params:
+            failures = []
+            # Merge results in the order of work
+            for res, error in imap_ordered(lambda w: w[0](w[1]), gen_work(update_params),
+                                           self.feeder_workers):
+                for param, done in res:
                     code, field, bubbles, gaps = param
                     b_len = len(gaps)-1
-                    for i, gap in enumerate(gaps):
-                        # Download data
-                        start, end = gap.to_actualrange()
-                        df: DataFrame = self.feeder_func(
-                            code, field, start, end)
+                    for i, (gap, df) in enumerate(done):
                         # Binding data
                         result[field] = binding_data(
                             result[field], df, code, field)
@@ -731,37 +1166,54 @@ class StaColInterface(ColInterfaceBase):
                             yield result
                             result = defaultdict(DataFrame)
                     self.manager.status[code, field] = bubbles
-                if len(result) != 0:
-                    yield result
-            except FeederFunctionError:
-                self.manager.status[code, field] = bubbles
+                if error is not None:
+                    codes, fields, e = error
+                    failures += codes
+                    print('Codes: {0} fields: {1} failed to update: {2}'.format(
+                        codes, fields, repr(e)))
+            if len(result) != 0:
                 yield result
+            if len(failures) != 0:
+                print('Total {0} codes failed to update: {1}'.format(
+                    len(failures), failures))
+
+        def prefetch_by_window(update_params, prefetch):
+            '''Prefetch prefetch_codes codes at a time as workers reach them.
+
+            Work is taken lazily, so only the window being downloaded and
+            the next one are held by the feeder at any time.'''
+            window = []
+            n = 0
+            for _, params in groupby(update_params, key=lambda p: p[0]):
+                window += list(params)
+                n += 1
+                if n == self.prefetch_codes:
+                    yield from prefetch(window)
+                    window = []
+                    n = 0
+            if window:  # if not empty
+                yield from prefetch(window)
 
         def write_batch_to_db(batches):
-            def convert_2_bulks(df):
-                bulks = []
-                for i, v in df.dropna().iterrows():
-                    q_doc = {self.date_name: i.to_pydatetime()}
-                    u_doc = v.to_dict()
-                    bulks.append(
-                        UpdateOne(q_doc, {'$set': u_doc}, upsert=True))
-                return bulks
-
             for field, df in batches.items():
                 df.columns = mongodb_name_compliance(df.columns)
-                bulks = convert_2_bulks(df)
                 subcol = self.col[field.upper().replace('.', '~')]
-                if bulks:  # if not empty
-                    subcol.bulk_write(bulks, ordered=False)
+                self._write_wide(subcol, df)
 
         def create_index():
             for field in mongodb_name_compliance(fields):
-                subcol = self.col[field]
-                subcol.create_index(self.date_name, unique=True)
+                self._create_field_index(self.col[field])
 
         create_index()
         update_params = self.manager.solve_update_params(
             codes, fields, startdate, enddate)
+        # Feeder may download gaps ahead, a window of codes in one go, and
+        # drop params it can not serve, e.g. when out of quota
+        prefetch = getattr(self.feeder_func, 'prefetch', None)
+        if prefetch is not None:
+            update_params = prefetch_by_window(update_params, prefetch)
+        # Shared by every interface downloading from the same source
+        limit = source_limit(self.col.database.name, self.feeder_workers)
 
         # single thread version
         '''for param in update_params:
@@ -771,21 +1223,185 @@ class StaColInterface(ColInterfaceBase):
             for batches in gen_data_by_batches(update_params, 500):
                 exe.submit(write_batch_to_db, batches)
 
-        self.manager.log.flush()
+        self.manager.flush()
+
+    def _feed(self, code: str, fields: list, start: datetime, end: datetime) -> dict:
+        '''Download fields of code, return {field: DataFrame holding field}.
+
+        Feeders marked by frame_feeder return every field in one frame and
+        are called once, other feeders are called once per field.'''
+        if getattr(self.feeder_func, 'frame_feeder', False):
+            df = self.feeder_func(code, fields, start, end)
+            if df is None:
+                raise FeederFunctionError('Feeder returned no data.')
+            return {field: df for field in fields}
+        res = {}
+        for field in fields:
+            df = self.feeder_func(code, field, start, end)
+            if df is None:
+                raise FeederFunctionError('Feeder returned no data.')
+            res[field] = df
+        return res
+
+    def _create_field_index(self, subcol: Collection):
+        subcol.create_index(self.date_name, unique=True)
 
     def _insert(self, df: DataFrame, code, field, bubble):
         '''Insert DataFrame into each sub collections accordingly.'''
-        def convert_2_bulks(df):
-            bulks = []
-            for _, v in df.iterrows():
-                q_doc = {self.date_name: v[self.date_name]}
-                code_name = code.upper().replace('.', '~')
-                u_doc = {code_name: v[field]}
-                bulks.append(
-                    UpdateOne(q_doc, {'$set': u_doc}, upsert=True))
-            return bulks
-
         if not df.empty:
-            bulks = convert_2_bulks(df)
+            wide = df.set_index(self.date_name)[[field]]
+            wide.columns = [code.upper().replace('.', '~')]
             subcol = self.col[field.upper().replace('.', '~')]
+            self._write_wide(subcol, wide)
+
+    def _write_wide(self, subcol: Collection, df: DataFrame,
+                    block_size: int = 500, chunk_size: int = 1000):
+        '''Upsert a date indexed wide DataFrame, one $set per date and column block.
+
+        Update documents are built from the underlying arrays block by
+        block, NaN cells are skipped and requests are sent to bulk_write
+        in chunks of chunk_size.'''
+        def gen_requests():
+            dates = pd.DatetimeIndex(df.index).to_pydatetime()
+            for c in range(0, df.shape[1], block_size):
+                block = df.iloc[:, c:c+block_size]
+                columns = np.array(block.columns, dtype=object)
+                values = block.to_numpy(dtype=object)
+                mask = block.notna().to_numpy()
+                for i in np.flatnonzero(mask.any(axis=1)):
+                    cols = mask[i]
+                    u_doc = dict(zip(columns[cols], values[i, cols]))
+                    yield UpdateOne({self.date_name: dates[i]},
+                                    {'$set': u_doc}, upsert=True)
+
+        bulks = []
+        for request in gen_requests():
+            bulks.append(request)
+            if len(bulks) == chunk_size:
+                subcol.bulk_write(bulks, ordered=False)
+                bulks = []
+        if bulks:  # if not empty
             subcol.bulk_write(bulks, ordered=False)
+
+
+class PackedStaColInterface(StaColInterface):
+    '''StaColInterface keeping each code of a field as packed arrays.
+
+    Every field sub collection holds one document per code and year:
+        {code_name: code, 'year': year, 'dtype': 'f8',
+         'dates': datetime64[ns] as int64 bytes, 'values': float64 bytes}
+    so a query reads only the requested codes and builds the wide frame
+    from NumPy buffers. Non numeric values are kept as a list with dtype
+    'object'.
+    Selected by setting storage: 'packed'.'''
+
+    def __init__(self, col: Collection, feeder_func, setting: dict = None):
+        super().__init__(col, feeder_func, setting)
+        # Writes read and replace whole documents
+        self._write_lock = Lock()
+
+    def _create_field_index(self, subcol: Collection):
+        subcol.create_index([(self.code_name, 1), ('year', 1)], unique=True)
+
+    @staticmethod
+    def _pack(s: pd.Series) -> dict:
+        dates = s.index.values.astype('datetime64[ns]').view('int64')
+        if s.dtype == object:
+            s = s.infer_objects()
+        if s.dtype.kind in 'biuf':
+            return {'dtype': 'f8',
+                    'dates': Binary(dates.tobytes()),
+                    'values': Binary(s.to_numpy(dtype='float64').tobytes())}
+        else:
+            return {'dtype': 'object',
+                    'dates': Binary(dates.tobytes()),
+                    'values': s.tolist()}
+
+    @staticmethod
+    def _unpack(doc: dict) -> pd.Series:
+        dates = np.frombuffer(doc['dates'], dtype='int64').view('datetime64[ns]')
+        if doc['dtype'] == 'f8':
+            values = np.frombuffer(doc['values'], dtype='float64')
+        else:
+            values = np.empty(len(doc['values']), dtype=object)
+            values[:] = doc['values']
+        return pd.Series(values, index=dates)
+
+    def _read_field(self, field: str, codes: list, startdate: datetime,
+                    enddate: datetime, engine: Optional[str] = None) -> DataFrame:
+        q_doc = {self.code_name: {'$in': codes},
+                 'year': {'$gte': startdate.year, '$lte': enddate.year}}
+        cursor = self.col[field].find(q_doc, {'_id': 0}).sort(
+            [(self.code_name, 1), ('year', 1)])
+        series = {}
+        for code, docs in groupby(cursor, key=lambda d: d[self.code_name]):
+            series[code] = pd.concat([self._unpack(d) for d in docs])
+        if len(series) == 0:
+            return DataFrame()
+        df = DataFrame(series)
+        df = df.loc[(df.index >= startdate) & (df.index <= enddate)]
+        df = df[[c for c in codes if c in series]]
+        df.index.name = self.date_name
+        return df.reset_index()
+
+    def iter_field(self, field: str, chunk_size: int = 50000,
+                   engine: Optional[str] = None):
+        name = field.replace('~', '.')
+
+        def gen():
+            cursor = self.col[field].find({}, {'_id': 0}).sort(
+                [('year', 1), (self.code_name, 1)]).batch_size(100)
+            for doc in cursor:
+                s = self._unpack(doc)
+                yield DataFrame({self.date_name: s.index,
+                                 self.code_name: doc[self.code_name].replace('~', '.'),
+                                 name: s.values})
+
+        return rechunk(gen(), chunk_size)
+
+    def _clear(self, subcol: Collection, code: str, start: datetime, end: datetime):
+        with self._write_lock:
+            for doc in subcol.find({self.code_name: code,
+                                    'year': {'$gte': start.year, '$lte': end.year}}):
+                s = self._unpack(doc)
+                s = s[(s.index < start) | (s.index >= end)]
+                f_doc = {self.code_name: code, 'year': doc['year']}
+                if s.empty:
+                    subcol.delete_one(f_doc)
+                else:
+                    subcol.replace_one(f_doc, dict(f_doc, **self._pack(s)))
+
+    def _write_wide(self, subcol: Collection, df: DataFrame,
+                    block_size: int = 500, chunk_size: int = 1000):
+        '''Merge a date indexed wide DataFrame into the packed documents.'''
+        df = df.set_axis(pd.DatetimeIndex(df.index), axis=0).sort_index()
+        years = df.index.year
+
+        def gen_requests():
+            for year in np.unique(years):
+                year = int(year)
+                block = df[years == year]
+                codes = list(block.columns)
+                old = {d[self.code_name]: d for d in subcol.find(
+                    {self.code_name: {'$in': codes}, 'year': year})}
+                for code in codes:
+                    s = block[code].dropna()
+                    if s.empty:
+                        continue
+                    if code in old:
+                        # New values take precedence
+                        s = s.combine_first(self._unpack(old[code]))
+                    doc = {self.code_name: code, 'year': year}
+                    doc.update(self._pack(s))
+                    yield ReplaceOne({self.code_name: code, 'year': year},
+                                     doc, upsert=True)
+
+        with self._write_lock:
+            bulks = []
+            for request in gen_requests():
+                bulks.append(request)
+                if len(bulks) == chunk_size:
+                    subcol.bulk_write(bulks, ordered=False)
+                    bulks = []
+            if bulks:  # if not empty
+                subcol.bulk_write(bulks, ordered=False)
@@ -2,6 +2,7 @@ from datetime import datetime, timedelta
 from collections import defaultdict
 
 from pymongo.collection import Collection
+from pymongo import UpdateOne
 
 from fdm.utils.data_structure import Bubbles
 from fdm.utils.tools import mongodb_name_compliance
@@ -16,6 +17,11 @@ class Manager():
         code, field = key
         self.status[code, field] = value
 
+    def flush(self):
+        '''Commit cached status and log to database.'''
+        self.status.flush()
+        self.log.flush()
+
     def solve_update_params(self, codes: list,
                             fields: list,
                             start: datetime,
@@ -65,11 +71,15 @@ class FieldStore():
         return iter(self.cache)
 
     def append(self, fields):
-        for field in fields:
-            if not field in self:
-                r = self.col.insert_one({'field': field})
-                assert r.acknowledged
-                self.cache.add(field)
+        new_fields = {field for field in fields if not field in self}
+        if len(new_fields) != 0:
+            requests = [UpdateOne({'field': field},
+                                  {'$setOnInsert': {'field': field}},
+                                  upsert=True)
+                        for field in sorted(new_fields)]
+            r = self.col.bulk_write(requests, ordered=False)
+            assert r.acknowledged
+            self.cache.update(new_fields)
 
     def drop(self, field: str):
         if field in self:
@@ -82,16 +92,26 @@ class FieldStore():
 
 
 class FieldStatus():
-    def __init__(self, col: Collection):
+    '''FieldStatus keep track of date ranges downloaded for each (code, field).
+
+    Assignments are cached and committed by flush, as one unordered
+    bulk write of upserts per code. Cache is flushed automatically when
+    it reaches batch_size or before any read.'''
+
+    def __init__(self, col: Collection, batch_size: int = 1000):
         self.col: Collection = col['__FieldStatus']
         self.fields = FieldStore(col)
         self.col.create_index('code', unique=True)
+        self.cache: dict = {}
+        self.batch_size = batch_size
 
     def __iter__(self):
+        self.flush()
         for i in self.col.find():
             yield i
 
     def __getitem__(self, key):
+        self.flush()
         codes, fields = key
         codes = [codes] if isinstance(codes, str) else codes
         fields = [fields] if isinstance(fields, str) else fields
@@ -120,31 +140,39 @@ class FieldStatus():
         code = code.upper().replace('.', '~')
         field = field.upper().replace('.', '~')
 
-        self.fields.append([field])
-        if code in self.col.distinct('code'):
-            r = self.col.update_one({'code': code},
-                                    {'$set': {field: value.to_list()}})
-            assert r.acknowledged
-        else:
-            r = self.col.insert_one({'code': code, field: value.to_list()})
-            assert r.acknowledged
+        self.cache[code, field] = value.to_list()
+        if len(self.cache) >= self.batch_size:
+            self.flush()
 
     def __delitem__(self, key):
+        self.flush()
         code, fields = key
 
         code = code.upper().replace('.', '~')
-        fields = fields.upper().replace('.', '~')
-
-        if code in self.col.distinct('code'):
-            if isinstance(fields, str):
-                fields = [fields]
-            del_dict = {k: '' for k in fields}
-            r = self.col.update_one({'code': code},
-                                    {'$unset': del_dict})
-            assert r.acknowledged
-        else:
+        fields = mongodb_name_compliance(fields)
+        if isinstance(fields, str):
+            fields = [fields]
+
+        del_dict = {k: '' for k in fields}
+        r = self.col.update_one({'code': code},
+                                {'$unset': del_dict})
+        assert r.acknowledged
+        if r.matched_count == 0:
             raise KeyError('Code {} not found in database.'.format(code))
 
+    def flush(self):
+        '''Commit cached status to database.'''
+        if len(self.cache) != 0:
+            docs: defaultdict = defaultdict(dict)
+            for (code, field), value in self.cache.items():
+                docs[code][field] = value
+            self.fields.append({field for _, field in self.cache})
+            requests = [UpdateOne({'code': code}, {'$set': doc}, upsert=True)
+                        for code, doc in docs.items()]
+            r = self.col.bulk_write(requests, ordered=False)
+            assert r.acknowledged
+            self.cache = {}
+
 
 class Logger():
     def __init__(self, col: Collection):
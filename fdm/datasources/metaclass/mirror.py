@@ -0,0 +1,225 @@
+import json
+import os
+import shutil
+import zlib
+from datetime import datetime
+from time import monotonic
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from fdm.utils.tools import del_id
+
+
+class ParquetMirror:
+    '''Local Parquet copy of a ColInterface collection, needs pyarrow.
+
+    Every year sub collection is exported to <path>/<db>/<collection>/<year>.parquet,
+    or to <year>/<bucket>.parquet files when code_buckets is set, codes
+    being spread over buckets by crc32. The last date exported and the
+    write version of the collection (see ColInterface.write_state) are
+    kept in _meta.json.
+
+    sync exports again the year holding the last date exported, years
+    after it, and every year written since the version exported, so
+    history rewritten through the interface is picked up too.
+    is_fresh compares versions, its result is kept for fresh_ttl seconds
+    or until the next write through the interface.
+    '''
+
+    def __init__(self, interface, path: str, code_buckets: int = 0,
+                 fresh_ttl: float = 60):
+        self.interface = interface
+        self.code_buckets = code_buckets
+        self.fresh_ttl = fresh_ttl
+        self.root = os.path.join(os.path.expanduser(path),
+                                 interface.col.database.name,
+                                 interface.col.name)
+        # (expire time, interface writes, result) of the last is_fresh
+        self._fresh = None
+
+    # ----------------------------------------
+    # High-water mark
+    # ----------------------------------------
+    def meta(self) -> dict:
+        try:
+            with open(os.path.join(self.root, '_meta.json'), 'r', encoding='utf-8') as file:
+                return json.loads(file.read())
+        except (OSError, ValueError):
+            return {}
+
+    def lastdate(self, meta: dict = None) -> Optional[datetime]:
+        '''Return the last date exported, None if never synced.'''
+        meta = self.meta() if meta is None else meta
+        if meta.get('code_buckets') != self.code_buckets or \
+                'lastdate' not in meta or 'version' not in meta:
+            return None
+        return datetime.fromisoformat(meta['lastdate'])
+
+    def is_fresh(self) -> bool:
+        '''Whether the mirror holds every write made to Mongo.'''
+        cached = self._fresh
+        if cached is not None and cached[0] > monotonic() and \
+                cached[1] == self.interface.writes:
+            return cached[2]
+        writes = self.interface.writes
+        meta = self.meta()
+        fresh = self.lastdate(meta) is not None and \
+            meta['version'] == self.interface.write_state()['version']
+        self._fresh = (monotonic() + self.fresh_ttl, writes, fresh)
+        return fresh
+
+    # ----------------------------------------
+    # Export
+    # ----------------------------------------
+    def sync(self, full: bool = False, engine: Optional[str] = None) -> list:
+        '''Export year sub collections after the high-water mark, return years exported.'''
+        import pyarrow  # Fail before touching files if not installed
+        old_meta = self.meta()
+        lastdate = None if full else self.lastdate(old_meta)
+        state = self.interface.write_state()
+        if lastdate is not None and old_meta['version'] == state['version']:
+            return []
+        if lastdate is None and os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(self.root, exist_ok=True)
+
+        src_years = self.interface.list_subcollection_names()
+        years = src_years
+        if lastdate is not None:
+            years = [y for y in years if int(y) >= lastdate.year
+                     or state['touched'].get(y, 0) > old_meta['version']]
+            # Years dropped in Mongo
+            for name in os.listdir(self.root):
+                year = name.split('.')[0]
+                if year.isdigit() and year not in src_years:
+                    self._remove_year(year)
+        for year in years:
+            self._export_year(year, engine)
+            print('{0} year {1} exported.'.format(
+                self.interface.full_name(), year))
+
+        try:
+            src_lastdate = self.interface.lastdate()
+        except IndexError:
+            # Empty collection
+            src_lastdate = datetime(1900, 1, 1)
+        meta = {'lastdate': src_lastdate.isoformat(),
+                'version': state['version'],
+                'synced_at': datetime.now().isoformat(),
+                'code_buckets': self.code_buckets}
+
+        def write_meta(path):
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(json.dumps(meta))
+
+        self._write_atomic(os.path.join(self.root, '_meta.json'), write_meta)
+        self._fresh = None
+        return years
+
+    def _remove_year(self, year: str):
+        file = os.path.join(self.root, year + '.parquet')
+        folder = os.path.join(self.root, year)
+        if os.path.exists(file):
+            os.remove(file)
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+
+    def _export_year(self, year: str, engine=None):
+        df = del_id(self.interface._find_frame(
+            self.interface.col[year], {}, engine=engine))
+        if df.empty:
+            # Left by create_index or delete_by_code, a file without columns
+            # would fail filtered reads
+            self._remove_year(year)
+            return
+        if self.code_buckets <= 0:
+            self._write_parquet(os.path.join(self.root, year + '.parquet'), df)
+            return
+        folder = os.path.join(self.root, year)
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+        buckets = self._buckets(df[self.interface.code_name])
+        for bucket in np.unique(buckets):
+            self._write_parquet(self._bucket_path(year, bucket),
+                                df[buckets == bucket])
+
+    def _write_parquet(self, path: str, df: DataFrame):
+        self._write_atomic(path, lambda p: df.to_parquet(p, index=False))
+
+    @staticmethod
+    def _write_atomic(path: str, write):
+        tmp = path + '.tmp'
+        write(tmp)
+        os.replace(tmp, path)
+
+    def _buckets(self, codes: pd.Series) -> np.ndarray:
+        mapping = {c: zlib.crc32(str(c).encode()) % self.code_buckets
+                   for c in codes.unique()}
+        return codes.map(mapping).to_numpy()
+
+    def _bucket_path(self, year: str, bucket: int) -> str:
+        return os.path.join(self.root, year, '{0:04d}.parquet'.format(bucket))
+
+    # ----------------------------------------
+    # Read
+    # ----------------------------------------
+    def read(self, codes=None, startdate: datetime = None, enddate: datetime = None,
+             fields: Optional[list] = None) -> DataFrame:
+        '''Read records like ColInterface.query over a date range.
+
+        Only the files of years, and buckets of codes, in range are opened,
+        fields and the date/code predicate are pushed down to the reader.'''
+        import pyarrow.parquet as pq
+        code_name = self.interface.code_name
+        date_name = self.interface.date_name
+        if isinstance(codes, str):
+            codes = [codes]
+        if fields is not None:
+            fields = list(set(fields).union((code_name, date_name)))
+
+        filters = []
+        if codes is not None:
+            filters.append((code_name, 'in', list(codes)))
+        if startdate is not None:
+            filters.append((date_name, '>=', pd.Timestamp(startdate)))
+        if enddate is not None:
+            filters.append((date_name, '<=', pd.Timestamp(enddate)))
+
+        frames = []
+        for path in self._files(codes, startdate, enddate):
+            schema = pq.read_schema(path)
+            if code_name not in schema.names or date_name not in schema.names:
+                # Empty year exported by an older version
+                continue
+            columns = None if fields is None else \
+                [f for f in fields if f in schema.names]
+            table = pq.read_table(path, columns=columns,
+                                  filters=filters if filters else None)
+            frames.append(table.to_pandas())
+        if len(frames) == 0:
+            return DataFrame()
+        return pd.concat(frames, ignore_index=True, sort=False)
+
+    def _files(self, codes, startdate, enddate) -> list:
+        exported = {name.split('.')[0] for name in os.listdir(self.root)
+                    if name[:4].isdigit()} if os.path.isdir(self.root) else set()
+        years = [y for y in sorted(exported)
+                 if (startdate is None or int(y) >= startdate.year)
+                 and (enddate is None or int(y) <= enddate.year)]
+        res = []
+        for year in years:
+            if self.code_buckets <= 0:
+                paths = [os.path.join(self.root, year + '.parquet')]
+            elif codes is None:
+                folder = os.path.join(self.root, year)
+                paths = [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+                         if f.endswith('.parquet')] if os.path.isdir(folder) else []
+            else:
+                buckets = np.unique(self._buckets(pd.Series(list(codes))))
+                paths = [self._bucket_path(year, b) for b in buckets]
+            res += [p for p in paths if os.path.exists(p)]
+        return res
@@ -1,15 +1,13 @@
 from datetime import datetime
-from collections import defaultdict
 from time import sleep
 
 import pandas as pd
 from pandas import DataFrame
 
-from fdm.utils.decorators import retry
+from fdm.utils.decorators import retry, frame_feeder
 
 
-def rebuilder(method, max_retry=10):
-    @retry(max_retry)
+def rebuilder(method):
     def downloader(code, pro, end_date,):
         func = getattr(
             pro,
@@ -23,8 +21,7 @@ def rebuilder(method, max_retry=10):
     return downloader
 
 
-def updater(method, max_retry=10):
-    @retry(max_retry)
+def date_downloader(method):
     def downloader(date, pro):
         func = getattr(
             pro,
@@ -37,15 +34,28 @@ def updater(method, max_retry=10):
     return downloader
 
 
-tushare_cache = defaultdict(DataFrame)
+def is_rate_limited(error: Exception) -> bool:
+    '''Whether error is Tushare refusing calls over the per minute limit.'''
+    return '每分钟最多访问' in str(error)
+
+
+def trade_dates(pro, start: datetime, end: datetime, exchange='SSE') -> list:
+    '''Return trading days between start and end as YYYYMMDD strings.'''
+    cal = pro.trade_cal(exchange=exchange,
+                        start_date=start.strftime('%Y%m%d'),
+                        end_date=end.strftime('%Y%m%d'),
+                        is_open='1')
+    return sorted(str(d) for d in cal['cal_date'])
+
 
 # -------------------------------
 # Trading Info
 # -------------------------------
 
 
-def trading_temp(func_name, min_columns_count):
-    def func(cls, code: str, field: str, start: datetime, end: datetime):
+def trading_temp(func_name):
+    @frame_feeder
+    def func(cls, code: str, fields: list, start: datetime, end: datetime):
         '''
         Feeder function for tushare {} info.'''.format(func_name)
 
@@ -61,30 +71,19 @@ def trading_temp(func_name, min_columns_count):
             df['trade_date'] = pd.to_datetime(df['trade_date'])
             df = df.rename(columns={'trade_date': 'date', 'ts_code': 'code'})
             return df
-        # If tushare_cache don't have the data then download
-        if tushare_cache[func_name, code].empty:
-            tushare_cache[func_name, code] = downloader(
-                code, start, end)
-        # Get result
-        data = tushare_cache[func_name, code]
-        res = data[['code', 'date', field]].copy()
-        # Remove returned data
-        del data[field]
-        # delete from cache if all data has been returned
-        if data.shape[1] == min_columns_count:
-            del tushare_cache[func_name, code]
-        return res
+        data = downloader(code, start, end)
+        return data[['code', 'date'] + fields]
     return func
 
 
 # Daily pricing data
-daily = trading_temp('daily', 2)
+daily = trading_temp('daily')
 
 # Daily adjust factor
-adj_factor = trading_temp('adj_factor', 2)
+adj_factor = trading_temp('adj_factor')
 
 # Daily trading info
-daily_basic = trading_temp('daily_basic', 2)
+daily_basic = trading_temp('daily_basic')
 
 
 # -------------------------------
@@ -92,8 +91,9 @@ daily_basic = trading_temp('daily_basic', 2)
 # -------------------------------
 
 
-def fs_temp(func_name, min_columns_count):
-    def func(cls, code: str, field: str, start: datetime, end: datetime):
+def fs_temp(func_name):
+    @frame_feeder
+    def func(cls, code: str, fields: list, start: datetime, end: datetime):
         '''
         Feeder function for tushare {} info.'''.format(func_name)
 
@@ -114,36 +114,25 @@ def fs_temp(func_name, min_columns_count):
                     pass
             df = df.rename(columns={'end_date': 'trade_date'})
             return df
-        # If tushare_cache don't have the data then download
-        if tushare_cache[func_name, code].empty:
-            tushare_cache[func_name, code] = downloader(
-                code, start, end)
-        # Get result
-        data = tushare_cache[func_name, code]
-        res = data[['ts_code', 'trade_date', field]].copy()
-        # Remove returned data
-        del data[field]
-        # delete from cache if all data has been returned
-        if data.shape[1] == min_columns_count:
-            del tushare_cache[func_name, code]
-        return res
+        data = downloader(code, start, end)
+        return data[['ts_code', 'trade_date'] + fields]
     return func
 
 
 # Income Statement
-income = fs_temp('income', 2)
+income = fs_temp('income')
 
 # Balance Sheet
-balancesheet = fs_temp('balancesheet', 2)
+balancesheet = fs_temp('balancesheet')
 
 # Cash Flow Statement
-cashflow = fs_temp('cashflow', 2)
+cashflow = fs_temp('cashflow')
 
 # Performence Forecast
-forecast = fs_temp('forecast', 2)
+forecast = fs_temp('forecast')
 
 # Performence Express
-express = fs_temp('express', 2)
+express = fs_temp('express')
 
 # Financial Matrix
-fina_indicator = fs_temp('fina_indicator', 2)
+fina_indicator = fs_temp('fina_indicator')
@@ -9,7 +9,10 @@ from pandas import DataFrame
 from fdm.datasources.metaclass import (_CollectionBase,
                                        _DbBase,
                                        _DynCollectionBase)
-from .feeder import rebuilder, updater, fs_temp
+from fdm.utils.concurrency import imap_ordered, rate_limit
+from fdm.utils.exceptions import FeederFunctionError
+from .feeder import (rebuilder, date_downloader, fs_temp,
+                     is_rate_limited, trade_dates)
 from .fields import *
 
 # -------------------------------
@@ -19,64 +22,173 @@ from .fields import *
 
 class _TushareCollectionBase(_CollectionBase):
     method_name = 'blank'
-
-    def _rebuild(self, download_function):
+    # Tushare calls allowed per minute for the account
+    calls_per_minute = 200
+    # Number of codes downloaded at the same time on rebuild
+    rebuild_workers = 4
+    # Number of days downloaded at the same time on update
+    update_workers = 4
+
+    def __init__(self, col, setting: dict):
+        super().__init__(col, setting)
+        self.calls_per_minute = setting.get(
+            'calls_per_minute', self.calls_per_minute)
+        self.rebuild_workers = setting.get(
+            'rebuild_workers', self.rebuild_workers)
+        self.update_workers = setting.get(
+            'update_workers', self.update_workers)
+
+    @staticmethod
+    def _call(throttle, func, *args, max_retry=10):
+        '''Call func under the shared throttle, retry on failure.
+
+        Calls refused by the rate limit slow the throttle down and are not
+        counted as failures. Raise the last error after max_retry failures.'''
+        failed, limited = 0, 0
+        while True:
+            throttle.acquire()
+            try:
+                res = func(*args)
+            except Exception as e:
+                if is_rate_limited(e) and limited < 10 * max_retry:
+                    limited += 1
+                    throttle.backoff()
+                    continue
+                failed += 1
+                if failed >= max_retry:
+                    raise
+                sleep(1)
+            else:
+                throttle.success()
+                return res
+
+    def _rebuild(self, download_function, resume=False, workers=None, max_retry=10):
+        '''Download full history of every code, several codes at a time.
+
+        Progress of every code is kept in the __Progress sub collection,
+        along with the end date of the rebuild under _id __rebuild.
+        With resume, codes finished by an earlier rebuild are skipped,
+        codes left half done are deleted and downloaded again, all up to
+        the end date of the earlier rebuild so that update finds no gap.'''
         import tushare as ts
-        # Drop all data in collection
-        self.interface.drop()
-        print('{0} droped'.format(self.interface.full_name()))
+        progress = self.interface.col['__Progress']
+        done = set()
+        lastdate = None
+        if resume:
+            for doc in progress.find():
+                if doc['_id'] == '__rebuild':
+                    lastdate = doc['enddate']
+                elif doc['done']:
+                    done.add(doc['_id'])
+                else:
+                    self.interface.delete_by_code(doc['_id'])
+            print('{0} codes already downloaded'.format(len(done)))
+        else:
+            # Drop all data in collection
+            self.interface.drop()
+            progress.drop()
+            print('{0} droped'.format(self.interface.full_name()))
+        if lastdate is None:
+            # minus one day to prevent imcomplete dataset been downloaded
+            lastdate = datetime.now()-timedelta(1)
+            progress.update_one({'_id': '__rebuild'},
+                                {'$set': {'enddate': lastdate}}, upsert=True)
         # Inititalize data source
         pro = ts.pro_api()
+        bucket = rate_limit('Tushare', self.calls_per_minute)
+        workers = self.rebuild_workers if workers is None else workers
+
+        def download(code):
+            progress.update_one({'_id': code}, {'$set': {'done': False}},
+                                upsert=True)
+            enddate = lastdate
+            try:
+                while True:
+                    df = self._call(bucket, download_function, code, pro, enddate,
+                                    max_retry=max_retry)
+                    if df is None:
+                        raise FeederFunctionError('Download failed.')
+                    if df.shape[0] == 0:
+                        break
+                    enddate = min(df['trade_date']) - timedelta(1)
+                    self.interface.insert_many(df)
+            except Exception as e:
+                return code, e
+            progress.update_one({'_id': code}, {'$set': {'done': True}})
+            return code, None
+
         # Get stock list
         stock_list = DataFrame()
         for status in "LDP":
+            bucket.acquire()
             stock_list = stock_list.append(pro.stock_basic(list_status=status))
+        codes = [c for c in stock_list['ts_code'] if c not in done]
         # Download data for each stock code
-        for _, value in stock_list.iterrows():
-            code = value['ts_code']
-            record_len = 1
-            # minus one day to prevent imcomplete dataset been downloaded
-            enddate = datetime.now()-timedelta(1)
-            while record_len != 0:
-                df = download_function(code, pro, enddate)
-                record_len = df.shape[0]
-                if record_len != 0:
-                    enddate = min(df['trade_date']) - timedelta(1)
-                    self.interface.insert_many(df)
-
-            print('Code: {0} downloaded.'.format(code))
-            sleep(0.6)
+        failures = []
+        for code, error in imap_ordered(download, codes, workers):
+            if error is None:
+                print('Code: {0} downloaded.'.format(code))
+            else:
+                failures.append(code)
+                print('Code: {0} failed: {1}'.format(code, repr(error)))
+        if len(failures) != 0:
+            print('Total {0} codes failed, rebuild with resume=True to retry: {1}'.format(
+                len(failures), failures))
         return 0
 
-    def _update(self, download_function):
+    def _update(self, download_function, workers=None, max_retry=10):
+        '''Download every trading day after the last date in DB.
+
+        Days are downloaded several at a time under the shared throttle,
+        which slows down whenever Tushare reports too many calls. Results
+        are written in date order with one insert_many per year, up to the
+        first day failing so that no gap is left behind lastdate.'''
         import tushare as ts
         # Inititalize data source
         pro = ts.pro_api()
+        throttle = rate_limit('Tushare', self.calls_per_minute)
+        workers = self.update_workers if workers is None else workers
         # Get last date in DB
         lastdate = self.interface.lastdate()
-        # Generate date range business day only
-        daterange = pd.date_range(start=lastdate+timedelta(1),
-                                  end=datetime.now(), freq="B")
+        # Trading days only
+        throttle.acquire()
+        dates = trade_dates(pro, lastdate+timedelta(1), datetime.now())
         print('Total {0} data points need to be downloaded.'.format(
-            len(daterange)))
-        # Download data for each day
-        for i in daterange:
-            date = i.strftime('%Y%m%d')
-            df = download_function(date, pro)
-            self.interface.insert_many(df)
+            len(dates)))
+
+        def download(date):
+            try:
+                df = self._call(throttle, download_function, date, pro,
+                                max_retry=max_retry)
+            except Exception as e:
+                return date, None, e
+            return date, df, None
+
+        frames, year = [], None
+        for date, df, error in imap_ordered(download, dates, workers):
+            if error is not None:
+                print('Date: {0} failed: {1}, update stopped.'.format(
+                    date, repr(error)))
+                break
+            if year is not None and date[:4] != year:
+                self.interface.insert_many(pd.concat(frames))
+                frames = []
+            year = date[:4]
+            frames.append(df)
             print('Date: {0} downloaded.'.format(date))
-            sleep(0.6)
+        if len(frames) != 0:
+            self.interface.insert_many(pd.concat(frames))
         return 0
 
-    def rebuild(self, buildindex=True):
-        self._rebuild(rebuilder(self.method_name))
+    def rebuild(self, buildindex=True, resume=False, workers=None):
+        self._rebuild(rebuilder(self.method_name), resume, workers)
         if buildindex:
             self.interface.create_indexs(
                 [self.interface.date_name, self.interface.code_name])
         return 0
 
-    def update(self):
-        self._update(updater(self.method_name))
+    def update(self, workers=None):
+        self._update(date_downloader(self.method_name), workers)
         return 0
 
 
@@ -150,15 +262,15 @@ class _FSTemp(_DynCollectionBase):
 
 
 class IncomeStatement(_FSTemp):
-    feeder_func = fs_temp('income', 2)
+    feeder_func = fs_temp('income')
     fields = income
 
 
 class BalanceSheet(_FSTemp):
-    feeder_func = fs_temp('balancesheet', 2)
+    feeder_func = fs_temp('balancesheet')
     fields = balance
 
 
 class CFStatement(_FSTemp):
-    feeder_func = fs_temp('cashflow', 2)
+    feeder_func = fs_temp('cashflow')
     fields = cashflow
@@ -4,7 +4,9 @@ from collections import defaultdict
 from pandas import DataFrame
 import pandas as pd
 
+from fdm.utils.decorators import multi_code_feeder
 from fdm.utils.exceptions import FeederFunctionError
+from .session import session, CONNECTION_ERRORS
 
 # ------------------------------
 # Feeder Template
@@ -13,11 +15,12 @@ from fdm.utils.exceptions import FeederFunctionError
 
 def feeder_factory(downloader, transformer):
     def generic_func(cls, code: str, field: str, start: datetime, end: datetime) -> DataFrame:
-        # Init wind api
-        from WindPy import w
-        w.start()
-        # unpack params
-        data = downloader(w, field, code, start, end)
+        # Borrow wind api from session
+        data = downloader(session.get(), field, code, start, end)
+        if data.ErrorCode in CONNECTION_ERRORS:
+            # Reconnect and try again once
+            session.invalidate()
+            data = downloader(session.get(), field, code, start, end)
 
         if data.ErrorCode == 0:
             # Transform data
@@ -34,7 +37,7 @@ def feeder_factory(downloader, transformer):
 # Feeders
 # ------------------------------
 
-def wsd():
+def wsd(codes_per_call=100):
     def wsd_downloader(w, field, code, start, end):
         # unpack params
         try:
@@ -42,7 +45,9 @@ def wsd():
         except:
             qfield = field
             qparam = ''
-        # Download data
+        # Download data, several codes of a field in one call
+        if not isinstance(code, str):
+            code = ','.join(code)
         data = w.wsd(code, qfield, start, end, qparam)
         return data
 
@@ -54,7 +59,8 @@ def wsd():
         df['date'] = pd.to_datetime(df['date'])
         return df[(df['date'] <= end) & (df['date'] >= start)]
 
-    return feeder_factory(wsd_downloader, wsd_transform)
+    func = feeder_factory(wsd_downloader, wsd_transform)
+    return multi_code_feeder(codes_per_call)(func)
 
 
 def edb():
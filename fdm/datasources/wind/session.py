@@ -0,0 +1,62 @@
+from threading import RLock
+
+from fdm.utils.exceptions import FeederFunctionError
+
+# Error codes meaning the terminal connection is gone
+CONNECTION_ERRORS = (-103,)
+
+
+class WindSession:
+    '''Process wide WindPy connection borrowed by Wind feeders.
+
+    The terminal is started on first use only and checked with
+    w.isconnected() every time it is borrowed, it is started again only if
+    the check fails or a feeder reports a connection error by invalidate.
+
+    api: object to use instead of WindPy.w, e.g. fdm.utils.test.FakeWindPy
+    '''
+
+    def __init__(self, api=None, wait_time: int = 120):
+        self.api = api
+        self.wait_time = wait_time
+        self.starts = 0
+        self._started = False
+        self._lock = RLock()
+
+    def use(self, api):
+        '''Replace the api object, next get will start it.'''
+        with self._lock:
+            self.api = api
+            self._started = False
+
+    def get(self):
+        '''Return a connected w.'''
+        with self._lock:
+            if self.api is None:
+                from WindPy import w
+                self.api = w
+            if not self._started or not self.api.isconnected():
+                self._start()
+            return self.api
+
+    def invalidate(self):
+        '''Mark the connection as broken, next get will start it again.'''
+        with self._lock:
+            self._started = False
+
+    def stop(self):
+        with self._lock:
+            if self._started:
+                self.api.stop()
+                self._started = False
+
+    def _start(self):
+        res = self.api.start(waitTime=self.wait_time)
+        if res.ErrorCode != 0:
+            raise FeederFunctionError(
+                'Wind failed to start, error code:{0}'.format(res.ErrorCode))
+        self._started = True
+        self.starts += 1
+
+
+session = WindSession()
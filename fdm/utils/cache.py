@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+
+from pandas import DataFrame
+
+from .config import config
+
+
+class _Entry:
+    __slots__ = ('df', 'nbytes', 'expire')
+
+    def __init__(self, df: DataFrame, ttl: float):
+        self.df = df
+        self.nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        self.expire = monotonic() + ttl
+
+
+class DownloadCache:
+    '''Thread safe cache of downloaded frames shared by feeders.
+
+    Frames downloaded ahead are put by a prefetch and popped by the feeder
+    using them. Entries are also dropped least recently used first once
+    the frames take more than max_bytes, and after ttl seconds, so an
+    update failing midway does not leave frames behind.
+    An entry larger than max_bytes is kept alone.'''
+
+    def __init__(self, max_bytes: int = 512 * 2**20, ttl: float = 600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = RLock()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry.expire > monotonic()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key):
+        '''Return frame of key or None if not cached.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expire <= monotonic():
+                self._drop(key, evicted=True)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry.df
+
+    def put(self, key, df: DataFrame):
+        '''Cache df under key.'''
+        entry = _Entry(df, self.ttl)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self.nbytes += entry.nbytes
+            self._evict()
+
+    def pop(self, key):
+        '''Remove and return frame of key, None if not cached.'''
+        with self._lock:
+            df = self.get(key)
+            if df is not None:
+                self._drop(key)
+            return df
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'nbytes': self.nbytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def _drop(self, key, evicted=False):
+        entry = self._entries.pop(key)
+        self.nbytes -= entry.nbytes
+        if evicted:
+            self.evictions += 1
+
+    def _evict(self):
+        now = monotonic()
+        for key in [k for k, e in self._entries.items() if e.expire <= now]:
+            self._drop(key, evicted=True)
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)), evicted=True)
+
+
+download_cache = DownloadCache(
+    int(config['cache']['max_mb'] * 2**20), config['cache']['ttl'])
@@ -0,0 +1,155 @@
+import struct
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+import bson
+from pymongo.collection import Collection
+
+
+def find_columnar(col: Collection, filter_doc: dict,
+                  fields: Optional[list] = None, sort: Optional[list] = None) -> DataFrame:
+    '''Run a find and build the DataFrame column by column.
+
+    Use pymongoarrow when it is installed, which decodes BSON straight into
+    Arrow arrays. Otherwise decode raw BSON batches one at a time, slicing
+    fields of uniformly laid out batches straight out of the bytes, see
+    decode_raw_batches.
+    _id is always excluded from the result.'''
+    projection = {'_id': 0}
+    if fields is not None:
+        projection.update({f: 1 for f in fields})
+
+    try:
+        from pymongoarrow.api import find_pandas_all
+    except ImportError:
+        pass
+    else:
+        kwargs = {'projection': projection}
+        if sort is not None:
+            kwargs['sort'] = sort
+        return find_pandas_all(col, filter_doc, **kwargs)
+
+    cursor = col.find_raw_batches(filter_doc, projection=projection)
+    if sort is not None:
+        cursor = cursor.sort(sort)
+    return decode_raw_batches(cursor)
+
+
+# BSON types decoded by _decode_uniform: type byte -> (dtype, value size)
+_FIXED_TYPES = {
+    0x01: ('<f8', 8),   # double
+    0x07: (None, 12),   # ObjectId
+    0x08: ('?', 1),     # bool
+    0x09: ('<i8', 8),   # UTC datetime in ms
+    0x0A: (None, 0),    # null
+    0x10: ('<i4', 4),   # int32
+    0x12: ('<i8', 8),   # int64
+}
+_STRING = 0x02
+# BSON datetimes (ms since epoch) representable as datetime64[ns]
+_MIN_MS = -(2**63 - 1) // 10**6 + 1
+_MAX_MS = (2**63 - 1) // 10**6
+
+
+def decode_raw_batches(batches) -> DataFrame:
+    '''Decode an iterable of raw BSON batches into a column oriented DataFrame.
+
+    A batch whose documents all share the same layout (keys, types and
+    string lengths, e.g. records of one year sub collection) is viewed as
+    a (documents, bytes) array and every field is sliced out as a column,
+    without building any document. Other batches are decoded as documents.
+    Columns appear in the order they are first seen, documents missing a
+    field get NaN/NaT in that column.'''
+    frames = []
+    for batch in batches:
+        df = _decode_uniform(batch)
+        if df is None:
+            df = DataFrame(bson.decode_all(batch))
+        if not df.empty:
+            frames.append(df)
+    if len(frames) == 0:
+        return DataFrame()
+    elif len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True, sort=False)
+
+
+def _layout(doc: bytes) -> Optional[list]:
+    '''Return [(key, type, offset, size)] of a flat document, None if unsupported.'''
+    res = []
+    pos = 4
+    end = len(doc) - 1
+    while pos < end:
+        t = doc[pos]
+        key_end = doc.index(b'\x00', pos + 1)
+        key = doc[pos + 1:key_end].decode('utf-8')
+        pos = key_end + 1
+        if t == _STRING:
+            size = 4 + struct.unpack_from('<i', doc, pos)[0]
+        elif t in _FIXED_TYPES:
+            size = _FIXED_TYPES[t][1]
+        else:
+            return None
+        res.append((key, t, pos, size))
+        pos += size
+    return res
+
+
+def _decode_uniform(batch: bytes) -> Optional[DataFrame]:
+    '''Decode a batch of identically laid out documents, None if they are not.'''
+    if len(batch) < 5:
+        return None
+    length = struct.unpack_from('<i', batch, 0)[0]
+    if len(batch) % length != 0:
+        return None
+    layout = _layout(batch[:length])
+    if layout is None:
+        return None
+
+    # Every byte but values must be the same in all documents
+    mask = np.ones(length, dtype=bool)
+    for _, t, offset, size in layout:
+        if t == _STRING:
+            # Keep length prefix and trailing null
+            mask[offset + 4:offset + size - 1] = False
+        else:
+            mask[offset:offset + size] = False
+    rows = np.frombuffer(batch, dtype='uint8').reshape(-1, length)
+    if not (rows[:, mask] == rows[0, mask]).all():
+        return None
+
+    n = rows.shape[0]
+    data = {}
+    for key, t, offset, size in layout:
+        block = rows[:, offset:offset + size]
+        if t == _STRING:
+            width = size - 5  # without length prefix and trailing null
+            if width == 0:
+                data[key] = np.full(n, '', dtype=object)
+                continue
+            values = np.ascontiguousarray(block[:, 4:-1])
+            if values.max() < 0x80:
+                # ASCII, decoded by NumPy at once
+                values = values.view('S{0}'.format(width)).ravel().astype('U')
+            else:
+                values = np.char.decode(values.view('S{0}'.format(width)).ravel(), 'utf-8')
+            data[key] = values.astype(object)
+        elif t == 0x07:
+            data[key] = np.array([bson.ObjectId(bytes(b)) for b in block],
+                                 dtype=object)
+        elif t == 0x0A:
+            data[key] = np.full(n, None, dtype=object)
+        else:
+            values = np.ascontiguousarray(block).view(_FIXED_TYPES[t][0]).ravel()
+            if t == 0x09:
+                if values.min() < _MIN_MS or values.max() > _MAX_MS:
+                    # Would overflow datetime64[ns], let bson decode it
+                    return None
+                values = values.astype('datetime64[ms]').astype('datetime64[ns]')
+            elif t == 0x10:
+                values = values.astype('int64')
+            data[key] = values
+    return DataFrame(data, columns=list(data.keys()), copy=False)
@@ -0,0 +1,108 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep
+
+_source_limits: dict = {}
+_source_limits_lock = Lock()
+_rate_limits: dict = {}
+
+
+def source_limit(source: str, limit: int) -> BoundedSemaphore:
+    '''Return the process wide semaphore bounding concurrent calls to a source.
+
+    The semaphore is created with `limit` slots on first use, later calls
+    with the same source share it whatever limit they pass.'''
+    with _source_limits_lock:
+        if source not in _source_limits:
+            _source_limits[source] = BoundedSemaphore(max(1, limit))
+        return _source_limits[source]
+
+
+def imap_ordered(func, iterable, workers: int, buffer: int = None):
+    '''Map func over iterable on a thread pool, yield results in input order.
+
+    At most `buffer` tasks (default 2 * workers) are pending at a time,
+    so iterable is consumed lazily and results do not pile up.
+    Exceptions raised by func are re-raised when its result is reached.'''
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    buffer = 2 * workers if buffer is None else max(buffer, 1)
+    with ThreadPoolExecutor(max_workers=workers) as exe:
+        pending: deque = deque()
+        for item in iterable:
+            pending.append(exe.submit(func, item))
+            if len(pending) >= buffer:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class TokenBucket:
+    '''Thread safe token bucket allowing `rate` calls per `per` seconds.
+
+    Up to `capacity` tokens (default one second worth, at least 1) can be
+    spent at once, acquire blocks until a token is available.'''
+
+    def __init__(self, rate: float, per: float = 60, capacity: float = None):
+        self.rate = rate / per
+        self.capacity = max(1, self.rate) if capacity is None else capacity
+        self._tokens = self.capacity
+        self._last = monotonic()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, tokens: float = 1):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            sleep(wait)
+
+
+class AdaptiveThrottle(TokenBucket):
+    '''TokenBucket adapting its rate to the source.
+
+    Rate is cut by `decrease` on backoff, e.g. when the source reports
+    too many calls, and grows back by `increase` calls per `per` seconds
+    on every success, never above the initial rate nor below min_rate.'''
+
+    def __init__(self, rate: float, per: float = 60, min_rate: float = None,
+                 increase: float = None, decrease: float = 0.5):
+        super().__init__(rate, per)
+        self.max_rate = self.rate
+        self.min_rate = self.max_rate / 20 if min_rate is None else min_rate / per
+        self.increase = self.max_rate / 50 if increase is None else increase / per
+        self.decrease = decrease
+
+    def success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def backoff(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # Spend what is left so callers wait at the new rate
+            self._tokens = min(self._tokens, 0)
+
+
+def rate_limit(source: str, calls_per_minute: float) -> AdaptiveThrottle:
+    '''Return the process wide throttle of a source.
+
+    Like source_limit, the first caller decides the rate.'''
+    with _source_limits_lock:
+        if source not in _rate_limits:
+            _rate_limits[source] = AdaptiveThrottle(calls_per_minute)
+        return _rate_limits[source]
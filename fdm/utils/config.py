@@ -3,11 +3,25 @@ config: dict = {
         "address": "127.0.0.1",
         "port": 27017
     },
+    "cache": {
+        "max_mb": 512,
+        "ttl": 600
+    },
+    "mirror": {
+        "path": "",
+        "code_buckets": 0,
+        "fresh_ttl": 60
+    },
     "Tushare": {
         "DBSetting": {
             "dbName": "tushareCache",
             "date_name": "trade_date",
             "code_name": "ts_code",
+            "feeder_workers": 2,
+            "storage": "wide",
+            "calls_per_minute": 200,
+            "rebuild_workers": 4,
+            "update_workers": 4,
             "colSetting": {
                 "DailyPrice": "dailyPricing",
                 "DailyBasic": "dailyBasic",
@@ -20,6 +34,7 @@ config: dict = {
             "dbName": "cleanData",
             "date_name": "date",
             "code_name": "code",
+            "panel_path": "",
             "colSetting": {
                 "Price": "price"
             }
@@ -30,6 +45,8 @@ config: dict = {
             "dbName": "wind",
             "date_name": "date",
             "code_name": "code",
+            "feeder_workers": 1,
+            "storage": "wide",
             "colSetting": {
                 "EDB": "EDB",
                 "WSD": "WSD",
@@ -43,6 +60,11 @@ config: dict = {
             "dbName": "jqData",
             "date_name": "date",
             "code_name": "code",
+            "feeder_workers": 4,
+            "storage": "wide",
+            "prefetch_concurrency": 8,
+            "prefetch_codes": 50,
+            "quota_reserve": 10000,
             "colSetting": {
 
             }
@@ -1,21 +1,34 @@
 from datetime import datetime
 from datetime import timedelta
 
-from copy import deepcopy
-
+import numpy as np
 import pandas as pd
 
 
 class TimeBubble:
+    '''Half open date range [min, max).
+
+    Endpoints are kept as integer day ordinals (see datetime.toordinal),
+    datetime objects are only built when min/max are read.'''
+    __slots__ = ('_lo', '_hi', '_step')
+
     def __init__(self, lower: datetime, upper: datetime, delta=timedelta(days=1)):
-        if lower > upper:
+        lo = lower.toordinal()
+        hi = upper.toordinal()
+        if lo > hi:
             raise ValueError(
                 'Upper {} is less then lower {}.'.format(upper, lower))
-        self.max: datetime = upper
-        self.min: datetime = lower
-        self.mid = self.max.timestamp() + self.min.timestamp()
-        self.leg = self.max.timestamp() - self.min.timestamp()
-        self.delta = delta
+        self._lo: int = lo
+        self._hi: int = hi
+        self._step: int = delta.days
+
+    @classmethod
+    def _from_ordinals(cls, lo: int, hi: int, step: int = 1):
+        res = cls.__new__(cls)
+        res._lo = lo
+        res._hi = hi
+        res._step = step
+        return res
 
     def __repr__(self):
         start = self.min
@@ -29,30 +42,47 @@ class TimeBubble:
         return '[{}, {})'.format(start, end)
 
     def __contains__(self, value):
-        try:
-            return self.min <= value < self.max
-        except:
-            return self.min <= value.min <= value.max < self.max
+        if isinstance(value, TimeBubble):
+            return self._lo <= value._lo and value._hi <= self._hi
+        return self._lo <= value.toordinal() < self._hi
 
     def __iter__(self):
-        date = self.min
-        while date < self.max:
-            yield date
-            date += self.delta
+        for o in range(self._lo, self._hi, self._step):
+            yield datetime.fromordinal(o)
+
+    @property
+    def min(self) -> datetime:
+        return datetime.fromordinal(self._lo)
+
+    @property
+    def max(self) -> datetime:
+        return datetime.fromordinal(self._hi)
+
+    @property
+    def mid(self) -> int:
+        return self._hi + self._lo
+
+    @property
+    def leg(self) -> int:
+        return self._hi - self._lo
+
+    @property
+    def delta(self) -> timedelta:
+        return timedelta(days=self._step)
 
     def iter_years(self):
         min_year: int = self.min.year
         max_year: int = self.max.year
         for year in range(min_year, max_year+1):
-            mi = max(self.min, datetime(year, 1, 1))
-            ma = min(self.max, datetime(year+1, 1, 1))
-            yield TimeBubble(mi, ma, self.delta)
+            mi = max(self._lo, datetime(year, 1, 1).toordinal())
+            ma = min(self._hi, datetime(year+1, 1, 1).toordinal())
+            yield TimeBubble._from_ordinals(mi, ma, self._step)
 
     def to_list(self) -> list:
         return [self.min, self.max]
 
     def to_actualrange(self) -> list:
-        return [self.min, self.max-self.delta]
+        return [self.min, datetime.fromordinal(self._hi - self._step)]
 
     def to_mongodb_date_range(self) -> dict:
         return {'$gte': self.min, '$lt': self.max}
@@ -63,113 +93,123 @@ class TimeBubble:
 
     def merge(self, bubble):
         if self._mergeable(bubble):
-            mi = min(self.min, bubble.min)
-            ma = max(self.max, bubble.max)
-            return TimeBubble(mi, ma), None
+            mi = min(self._lo, bubble._lo)
+            ma = max(self._hi, bubble._hi)
+            return TimeBubble._from_ordinals(mi, ma), None
         else:
             return self, bubble
 
     def carve(self, bubble):
         if self._mergeable(bubble):
-            l = self.min
-            u = bubble.min
-            left = TimeBubble(l, u) if l < u else None
-            l = bubble.max
-            u = self.max
-            right = TimeBubble(l, u) if l < u else None
+            l = self._lo
+            u = bubble._lo
+            left = TimeBubble._from_ordinals(l, u) if l < u else None
+            l = bubble._hi
+            u = self._hi
+            right = TimeBubble._from_ordinals(l, u) if l < u else None
             return left, right
         else:
             return self, None
 
     def intersect(self, bubble):
         if self._mergeable(bubble):
-            mi = max(self.min, bubble.min)
-            ma = min(self.max, bubble.max)
-            return TimeBubble(mi, ma, self.delta)
+            mi = max(self._lo, bubble._lo)
+            ma = min(self._hi, bubble._hi)
+            return TimeBubble._from_ordinals(mi, ma, self._step)
         else:
             return None
 
     def _mergeable(self, bubble):
-        return abs(self.mid - bubble.mid) <= (self.leg + bubble.leg)
+        return self._lo <= bubble._hi and bubble._lo <= self._hi
 
 
 class Bubbles():
-    def __init__(self, bubbles=[]):
-        self._bubbles = []
-        for b in (self._convert(b) for b in bubbles):
-            self._bubbles.append(b)
-        self._triple_kill()
+    '''Sorted set of disjoint half open time intervals.
+
+    Endpoints are kept in two int64 arrays of day ordinals, same as
+    TimeBubble.
+    Overlapping or touching intervals are merged when the set is built,
+    so every operation below is a linear scan or a binary search.'''
+
+    def __init__(self, bubbles=None):
+        pairs = [] if bubbles is None else \
+            [p for p in (self._convert(b) for b in bubbles) if p is not None]
+        if len(pairs) == 0:
+            lo = hi = np.empty(0, dtype='int64')
+        else:
+            lo, hi = (_to_ordinal(v) for v in zip(*pairs))
+        self._lo, self._hi = self._normalize(lo, hi)
 
     def __repr__(self):
-        return 'Bubbles({})'.format(self._bubbles)
+        return 'Bubbles({})'.format(list(self))
 
     def __str__(self):
-        return '[{}]'.format(',\n'.join([str(b) for b in self._bubbles]))
+        return '[{}]'.format(',\n'.join([str(b) for b in self]))
 
     def __contains__(self, value):
-        for b in self._bubbles:
-            if value in b:
-                return True
-        return False
+        if isinstance(value, TimeBubble):
+            lo, hi = value._lo, value._hi
+        else:
+            lo = hi = value.toordinal()
+        i = np.searchsorted(self._lo, lo, side='right') - 1
+        if i < 0:
+            return False
+        if isinstance(value, TimeBubble):
+            return hi <= self._hi[i]
+        return hi < self._hi[i]
 
     def __len__(self):
-        return len(self._bubbles)
+        return len(self._lo)
 
     def __getitem__(self, key):
-        return self._bubbles[key]
+        if isinstance(key, slice):
+            return [self._bubble(i) for i in range(len(self))[key]]
+        return self._bubble(range(len(self))[key])
 
     def __setitem__(self, key, value):
         try:
-            self._bubbles[key] = self._convert(value)
+            lo, hi = _to_ordinal(self._convert(value))
         except:
             raise ValueError(
                 'Value {} not compatible with Bubbles.'.format(value))
-        self._triple_kill()
+        new_lo, new_hi = self._lo.copy(), self._hi.copy()
+        new_lo[key], new_hi[key] = lo, hi
+        self._lo, self._hi = self._normalize(new_lo, new_hi)
 
     def __delitem__(self, key):
-        del self._bubbles[key]
+        self._lo = np.delete(self._lo, key)
+        self._hi = np.delete(self._hi, key)
 
     def __iter__(self):
-        return iter(self._bubbles)
+        for i in range(len(self)):
+            yield self._bubble(i)
 
     @property
     def min(self):
-        return self._bubbles[0].min
+        return _from_ordinal(self._lo[:1])[0]
 
     @property
     def max(self):
-        return self._bubbles[-1].max
+        return _from_ordinal(self._hi[-1:])[0]
 
     @property
     def isempty(self) -> bool:
-        if len(self._bubbles) == 0:
-            return True
-        else:
-            return False
+        return len(self._lo) == 0
 
     def gaps(self, bubble=None):
         '''Return gaps between bubbles.'''
-        fullbubble = TimeBubble(self.min, self.max) \
-            if bubble is None else self._convert(bubble)
-
-        res = Bubbles()
-        try:
-            for b in self._bubbles:
-                l, r = fullbubble.carve(b)
-                fullbubble = r
-                res._bubbles.append(l)
-        except AttributeError:
-            pass
-        finally:
-            res._bubbles.append(fullbubble)
-            res._triple_kill()
-            return res
+        if bubble is None:
+            lower, upper = self._lo[0], self._hi[-1]
+        else:
+            lower, upper = _to_ordinal(self._convert(bubble))
+        lo, hi = self._clip(lower, upper)
+        g_lo = np.concatenate(([lower], hi))
+        g_hi = np.concatenate((lo, [upper]))
+        keep = g_lo < g_hi
+        return self._from_arrays(g_lo[keep], g_hi[keep])
 
     def to_list(self) -> list:
-        res = []
-        for b in self._bubbles:
-            res.append(b.to_list())
-        return res
+        return [list(p) for p in zip(_from_ordinal(self._lo), _from_ordinal(self._hi))]
 
     def to_actualrange(self) -> list:
         res = []
@@ -178,56 +218,73 @@ class Bubbles():
         return res
 
     def merge(self, bubble):
-        res = Bubbles()
-        res._bubbles = deepcopy(self._bubbles)
-        res._bubbles.append(res._convert(bubble))
-        res._triple_kill()
-        return res
+        pair = self._convert(bubble)
+        if pair is None:
+            return self._from_arrays(self._lo, self._hi)
+        lo, hi = _to_ordinal(pair)
+        i = np.searchsorted(self._lo, lo)
+        return self._from_arrays(np.insert(self._lo, i, lo),
+                                 np.insert(self._hi, i, hi))
 
     def carve(self, bubble):
-        b_carve = self._convert(bubble)
-        res_list = []
-        for b in self._bubbles:
-            b1, b2 = b.carve(b_carve)
-            res_list.append(b1)
-            res_list.append(b2)
-
-        return Bubbles(res_list)
+        lower, upper = _to_ordinal(self._convert(bubble))
+        # Part of each bubble left and right to the carved one, interleaved
+        lo = np.column_stack((self._lo, np.maximum(self._lo, upper))).ravel()
+        hi = np.column_stack((np.minimum(self._hi, lower), self._hi)).ravel()
+        keep = lo < hi
+        return self._from_arrays(lo[keep], hi[keep])
 
     def intersect(self, bubble):
-        bubble = self._convert(bubble)
-        res = []
-        for s in self:
-            i = s.intersect(bubble)
-            res.append(i)
-        return Bubbles(res)
-
-    def _triple_kill(self):
-        self._drop_none()
-        self._sort()
-        self._squeeze()
-
-    def _squeeze(self):
-        p = 0
-        count = len(self._bubbles)
-        while p < count:
-            for q, b_q in ((q, b_q) for q, b_q in enumerate(self._bubbles) if q > p):
-                self._bubbles[p], self._bubbles[q] = self._bubbles[p].merge(
-                    b_q)
-            self._drop_none()
-            p += 1
-            count = len(self._bubbles)
-
-    def _sort(self):
-        self._bubbles.sort(key=lambda x: x.mid)
-
-    def _drop_none(self):
-        self._bubbles = [b for b in self._bubbles if b is not None]
+        lower, upper = _to_ordinal(self._convert(bubble))
+        return self._from_arrays(*self._clip(lower, upper))
+
+    def _bubble(self, i):
+        return TimeBubble._from_ordinals(int(self._lo[i]), int(self._hi[i]))
+
+    def _clip(self, lower, upper):
+        '''Return bubbles overlapping [lower, upper) clipped to it.'''
+        i = np.searchsorted(self._hi, lower, side='right')
+        j = np.searchsorted(self._lo, upper, side='left')
+        lo = np.maximum(self._lo[i:j], lower)
+        hi = np.minimum(self._hi[i:j], upper)
+        return lo, hi
+
+    @classmethod
+    def _from_arrays(cls, lo, hi):
+        res = cls()
+        res._lo, res._hi = cls._normalize(lo, hi)
+        return res
+
+    @staticmethod
+    def _normalize(lo, hi):
+        '''Sort, drop empty and merge overlapping or touching intervals.'''
+        keep = lo < hi
+        if not keep.all():
+            lo, hi = lo[keep], hi[keep]
+        if len(lo) == 0:
+            return lo, hi
+        if (lo[1:] < lo[:-1]).any():
+            order = np.argsort(lo, kind='mergesort')
+            lo, hi = lo[order], hi[order]
+        reach = np.maximum.accumulate(hi)
+        starts = np.flatnonzero(np.concatenate(([True], lo[1:] > reach[:-1])))
+        return lo[starts], np.maximum.reduceat(hi, starts)
 
     def _convert(self, value):
         if isinstance(value, TimeBubble):
-            return value
+            return value._lo, value._hi
         elif value is None:
             return None
         else:
-            return TimeBubble(min(value), max(value))
+            return min(value), max(value)
+
+
+def _to_ordinal(values) -> np.ndarray:
+    '''Convert datetimes or day ordinals to an int64 array of day ordinals.'''
+    return np.array([v if isinstance(v, (int, np.integer)) else v.toordinal()
+                     for v in values], dtype='int64')
+
+
+def _from_ordinal(values: np.ndarray) -> list:
+    '''Convert int64 day ordinals to a list of datetime.'''
+    return [datetime.fromordinal(int(v)) for v in values]
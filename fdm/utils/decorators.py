@@ -18,6 +18,27 @@ def retry(max_retry=10, wait=1):
     return decorator
 
 
+def frame_feeder(func):
+    '''Mark func as a feeder returning every requested field in one frame.
+
+    It is called as func(cls, code, fields, start, end) instead of once per
+    field with func(cls, code, field, start, end).'''
+    func.frame_feeder = True
+    return func
+
+
+def multi_code_feeder(codes_per_call=100):
+    '''Mark func as a feeder downloading one field of many codes at once.
+
+    It is called as func(cls, codes, field, start, end) with up to
+    codes_per_call codes sharing the same gap, and returns a frame with a
+    code column.'''
+    def decorator(func):
+        func.codes_per_call = codes_per_call
+        return func
+    return decorator
+
+
 def timeout(seconds_before_timeout):
     def deco(func):
         @functools.wraps(func)
@@ -21,6 +21,17 @@ def ord_test_feeder_func(code, field, start, end):
     return pd.DataFrame(gen())
 
 
+def test_frame_feeder_func(cls, code, fields, start, end):
+    dates = pd.date_range(start, end)
+    res = pd.DataFrame({'date': dates, 'code': code})
+    for field in fields:
+        res[field] = [code + field + i.strftime('%Y%m%d') for i in dates]
+    return res
+
+
+test_frame_feeder_func.frame_feeder = True
+
+
 def test_feeder_func_Q(cls, code, field, start, end):
     def gen():
         for i in pd.date_range(start, end, freq='Q'):
@@ -34,6 +45,75 @@ def test_feeder_func_Q(cls, code, field, start, end):
     return pd.DataFrame(gen())
 
 
+class WindData:
+    '''Result object returned by WindPy calls.'''
+
+    def __init__(self, ErrorCode=0, Codes=None, Fields=None, Times=None, Data=None):
+        self.ErrorCode = ErrorCode
+        self.Codes = [] if Codes is None else Codes
+        self.Fields = [] if Fields is None else Fields
+        self.Times = [] if Times is None else Times
+        self.Data = [] if Data is None else Data
+
+    def __repr__(self):
+        return 'WindData(ErrorCode={0})'.format(self.ErrorCode)
+
+
+class FakeWindPy:
+    '''Stand in for WindPy.w serving synthetic data.
+
+    wsd and edb return one business day series per code, values built like
+    ord_test_feeder_func. Calls are counted in `calls`, disconnect() makes
+    isconnected() False until started again.'''
+
+    def __init__(self):
+        self.connected = False
+        self.calls = {}
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def start(self, waitTime=120):
+        self._count('start')
+        self.connected = True
+        return WindData()
+
+    def stop(self):
+        self.connected = False
+
+    def isconnected(self):
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+
+    def _series(self, codes, fields, start, end):
+        if not self.connected:
+            return WindData(ErrorCode=-103)
+        codes = codes.split(',') if isinstance(codes, str) else list(codes)
+        fields = fields.split(',') if isinstance(fields, str) else list(fields)
+        times = [d.to_pydatetime() for d in pd.bdate_range(start, end)]
+        if len(codes) > 1 and len(fields) > 1:
+            return WindData(ErrorCode=-40522001)
+        data = [[code + field + t.strftime('%Y%m%d') for t in times]
+                for code in codes for field in fields]
+        return WindData(0, codes, fields, times, data)
+
+    def wsd(self, codes, fields, start, end, options=''):
+        self._count('wsd')
+        return self._series(codes, fields, start, end)
+
+    def edb(self, codes, start, end, options=''):
+        self._count('edb')
+        return self._series(codes, 'close', start, end)
+
+    def wset(self, table, options=''):
+        self._count('wset')
+        if not self.connected:
+            return WindData(ErrorCode=-103)
+        return WindData()
+
+
 test_config = {
     "Test": {
         "DBSetting": {
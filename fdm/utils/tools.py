@@ -15,7 +15,8 @@ def next_date(date: datetime, freq: str) -> datetime:
 def del_id(df) -> DataFrame:
     '''Delete column['_id'] from result'''
     if not df.empty:
-        del df['_id']
+        if '_id' in df.columns:
+            del df['_id']
         df.index = range(df.shape[0])
     return df
 
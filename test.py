@@ -33,6 +33,1117 @@ def multi_dummy():
     print(datetime.now()-time)
 
 
+def test_empty_feeder_result():
+    import mongomock
+    from fdm.datasources.metaclass.base import _DynCollectionBase
+
+    class Quarterly(_DynCollectionBase):
+        feeder_func = test_feeder_func_Q
+
+    col = Quarterly(mongomock.MongoClient()['test']['test'],
+                    test_config['Test']['DBSetting'])
+    # No quarter end in range, feeder returns DataFrame() without columns
+    res = col.query(['abc', 'cde'], 'cdb', datetime(2019, 1, 1),
+                    datetime(2019, 2, 15))
+    assert res.empty
+    res = col.query(['abc'], 'cdb', datetime(2019, 1, 1), datetime(2019, 6, 30))
+    assert list(res['ABC']) == ['abccdb20190331', 'abccdb20190630']
+
+
+def test_decode_raw_batches():
+    import bson
+    import pandas as pd
+    from fdm.utils.columnar import decode_raw_batches
+    docs = [{'code': 'code_' + str(i % 3), 'date': datetime(2019, 1, 1 + i),
+             'close': i * 1.5, 'volume': i, 'name': '平安银行'} for i in range(20)]
+    # Same layout, then strings of different lengths
+    mixed = [dict(doc, code=str(i) * i) for i, doc in enumerate(docs)]
+    for expected in (docs, mixed):
+        batch = b''.join(bson.encode(doc) for doc in expected)
+        pd.testing.assert_frame_equal(decode_raw_batches([batch]),
+                                      pd.DataFrame(expected))
+
+
+def test_mirror_empty_year():
+    import tempfile
+    import mongomock
+    from fdm.datasources.metaclass.interface import ColInterface
+    from fdm.datasources.metaclass.mirror import ParquetMirror
+
+    interface = ColInterface(mongomock.MongoClient()['test']['test'],
+                             test_config['Test']['DBSetting'])
+    interface.insert_many(ord_test_feeder_func(
+        'cde', 'close', datetime(2018, 12, 1), datetime(2018, 12, 31)))
+    interface.insert_many(ord_test_feeder_func(
+        'cde', 'close', datetime(2020, 1, 1), datetime(2020, 1, 31)))
+    # Empty 2019 sub collection, as left by create_index or delete_by_code
+    interface.col['2019'].create_index('code')
+
+    for code_buckets in (0, 4):
+        mirror = ParquetMirror(interface, tempfile.mkdtemp(), code_buckets)
+        mirror.sync()
+        assert mirror.is_fresh()
+        res = mirror.read('cde', datetime(2018, 12, 15), datetime(2020, 1, 15))
+        expected = interface.query('cde', startdate=datetime(2018, 12, 15),
+                                   enddate=datetime(2020, 1, 15))
+        assert len(res) == len(expected) == 32
+
+
+def test_tushare_rebuild_resume(monkeypatch):
+    import sys
+    import types
+    import mongomock
+    import pandas as pd
+    from fdm.datasources.tushare import model
+
+    class Pro:
+        def stock_basic(self, list_status):
+            codes = ['a', 'b', 'c'] if list_status == 'L' else []
+            return pd.DataFrame({'ts_code': codes})
+
+    class Clock(datetime):
+        today = datetime(2020, 1, 3, 12)
+
+        @classmethod
+        def now(cls, tz=None):
+            return cls.today
+
+    monkeypatch.setitem(sys.modules, 'tushare',
+                        types.SimpleNamespace(pro_api=Pro))
+    monkeypatch.setattr(model, 'datetime', Clock)
+    failing = {'b'}
+
+    def download(code, pro, enddate):
+        if code in failing:
+            raise ValueError('Connection lost')
+        dates = pd.date_range(datetime(2019, 12, 25), enddate)
+        return pd.DataFrame({'ts_code': code, 'trade_date': dates, 'close': 1.0})
+
+    col = model._TushareCollectionBase(
+        mongomock.MongoClient()['test']['test'],
+        {'code_name': 'ts_code', 'date_name': 'trade_date'})
+    col._rebuild(download, workers=1)
+    # Resumed the next day
+    Clock.today = datetime(2020, 1, 4, 12)
+    failing.clear()
+    col._rebuild(download, resume=True, workers=1)
+    df = col.interface.query(startdate=datetime(2019, 1, 1), enddate=datetime(2020, 12, 31))
+    lastdates = df.groupby('ts_code')['trade_date'].max()
+    assert list(lastdates.index) == ['a', 'b', 'c']
+    assert (lastdates == datetime(2020, 1, 2)).all()
+
+
+def test_prefetch_by_window():
+    import mongomock
+    from fdm.utils.test import test_frame_feeder_func
+
+    cached = set()
+    stats = {'prefetch': 0, 'max_cached': 0}
+
+    def feeder(code, fields, start, end):
+        assert code in cached
+        cached.discard(code)
+        return test_frame_feeder_func(None, code, fields, start, end)
+
+    def prefetch(params):
+        stats['prefetch'] += 1
+        cached.update(p[0] for p in params)
+        stats['max_cached'] = max(stats['max_cached'], len(cached))
+        return params
+
+    feeder.frame_feeder = True
+    feeder.prefetch = prefetch
+    setting = dict(test_config['Test']['DBSetting'], prefetch_codes=10)
+    interface = StaColInterface(mongomock.MongoClient()['test']['test'],
+                                feeder, setting)
+    codes = ['code_' + str(i) for i in range(95)]
+    res = interface.query(codes, ['cdb', 'cde'], datetime(2019, 1, 1),
+                          datetime(2019, 1, 10))
+    assert stats['prefetch'] == 10
+    assert stats['max_cached'] <= 20
+    assert res['CDB']['CODE_94'].iloc[-1] == 'code_94cdb20190110'
+
+
+def test_price_panel_grow():
+    import os
+    import tempfile
+    import numpy as np
+    import pandas as pd
+    from fdm.datasources.cleandata.panel import PricePanel
+
+    def records(codes, start, end):
+        dates = pd.date_range(start, end)
+        return pd.DataFrame({
+            'date': np.repeat(dates, len(codes)),
+            'code': codes * len(dates),
+            'close': np.arange(len(dates) * len(codes), dtype='float64')})
+
+    panel = PricePanel(tempfile.mkdtemp(), ['close'])
+    first = records(['code_' + str(i) for i in range(3)],
+                    datetime(2019, 1, 1), datetime(2019, 1, 10))
+    panel.append(first)
+    old_meta = panel.meta()
+    old_view = panel.view('close')
+    # More codes than capacity, fields move to larger files
+    panel.append(records(['code_' + str(i) for i in range(100)],
+                         datetime(2019, 1, 11), datetime(2019, 1, 20)))
+    meta = panel.meta()
+    assert meta['capacity'] == 128 and meta['files']['close'] == 'close.128.f8'
+    assert not os.path.exists(os.path.join(panel.path, old_meta['files']['close']))
+    expected = first.pivot(index='date', columns='code', values='close')
+    assert (old_view.values == expected.values).all()
+    assert (panel.view('close', enddate=datetime(2019, 1, 10),
+                       codes=list(expected.columns)).values == expected.values).all()
+    assert panel.view('close').shape == (20, 100)
+
+
+def test_replay_legacy_constituents():
+    import json
+    from fdm.datasources.joinquant.feeder import replay_constituents
+    # Full membership joined by ',,' as stored before change events
+    legacy = ['a,,b,,c', 'a,,b', '']
+    assert replay_constituents(legacy) == frozenset()
+    events = legacy[:2] + [
+        json.dumps({'added': ['d'], 'removed': ['a']}),
+        float('nan'),
+        json.dumps({'added': [], 'removed': []})]
+    assert replay_constituents(events) == frozenset(['b', 'd'])
+
+
+def test_constituents_force_update(monkeypatch):
+    import mongomock
+    from fdm.datasources.joinquant import api
+    from fdm.datasources.joinquant.model import Constituents
+
+    changes = {}
+
+    class FakeAPI:
+        def get_industry_stocks(self, code, date):
+            members = ['a', 'b']
+            for day, value in sorted(changes.items()):
+                if date >= day:
+                    members = value
+            return members
+
+    monkeypatch.setattr(api, 'JQDataAPI', FakeAPI)
+    for storage in ('wide', 'packed'):
+        setting = dict(test_config['Test']['DBSetting'], storage=storage)
+        cons = Constituents(mongomock.MongoClient()['test']['test'], setting)
+        changes.update({datetime(2019, 2, 1): ['a', 'c']})
+        cons.update('801150', datetime(2019, 1, 1), datetime(2019, 3, 29))
+        assert cons.members('801150', datetime(2019, 2, 15)) == {'a', 'c'}
+
+        # Download again with another history
+        changes.clear()
+        changes.update({datetime(2019, 3, 1): ['b', 'd']})
+        cons.update('801150', datetime(2019, 1, 15), datetime(2019, 3, 29),
+                    force_update=True)
+        assert cons.members('801150', datetime(2019, 2, 15)) == {'a', 'b'}
+        assert cons.members('801150', datetime(2019, 3, 15)) == {'b', 'd'}
+
+        res = cons.query('801150', datetime(2019, 2, 27), datetime(2019, 3, 4))
+        assert list(res['801150']) == ['a,,b', 'a,,b', 'b,,d', 'b,,d']
+        changes.clear()
+
+
+def test_fillna_reads_windows():
+    import mongomock
+    import numpy as np
+    import pandas as pd
+    from fdm.datasources.metaclass.interface import ColInterface
+
+    interface = ColInterface(mongomock.MongoClient()['test']['test'],
+                             test_config['Test']['DBSetting'])
+    dates = pd.bdate_range(datetime(2019, 1, 1), datetime(2019, 12, 31))
+    df = pd.DataFrame({'date': np.repeat(dates, 3),
+                       'code': ['a', 'b', 'c'] * len(dates),
+                       'close': np.arange(3 * len(dates), dtype='float64')})
+    interface.insert_many(df)
+
+    read = []
+    find_frame = interface._find_frame
+
+    def spy(*args, **kwargs):
+        res = find_frame(*args, **kwargs)
+        read.append(len(res))
+        return res
+
+    interface._find_frame = spy
+    res = interface.query(startdate=datetime(2019, 1, 1), enddate=datetime(2019, 12, 31),
+                          freq='M', fillna='ffill')
+    month_ends = pd.date_range(datetime(2019, 1, 1), datetime(2019, 12, 31), freq='M')
+    expected = df.groupby([df['date'].dt.to_period('M'), 'code']).last()
+    assert len(res) == 36
+    assert list(res.sort_values(['date', 'code'])['close']) == list(expected['close'])
+    # Month ends on weekends: March, June, August and November
+    missing = [d for d in month_ends if d.dayofweek >= 5]
+    assert len(missing) == 4
+    assert sum(read) <= 36 + sum(
+        3 * len(pd.bdate_range(d - pd.offsets.MonthBegin(), d)) for d in missing)
+
+
+def test_decode_out_of_range_dates():
+    import bson
+    import pandas as pd
+    from fdm.utils.columnar import decode_raw_batches
+    # Beyond datetime64[ns] on both sides
+    for date in (datetime(2300, 1, 1), datetime(1600, 1, 1)):
+        docs = [{'code': 'abc', 'date': date}, {'code': 'cde', 'date': datetime(2019, 1, 1)}]
+        batch = b''.join(bson.encode(doc) for doc in docs)
+        res = decode_raw_batches([batch])
+        assert list(res['date']) == [date, datetime(2019, 1, 1)]
+        pd.testing.assert_frame_equal(res, pd.DataFrame(docs))
+
+
+def test_tushare_rebuild_rate_limited(monkeypatch):
+    import sys
+    import types
+    import mongomock
+    import pandas as pd
+    from fdm.datasources.tushare import model
+    from fdm.utils.concurrency import AdaptiveThrottle
+
+    class Pro:
+        def stock_basic(self, list_status):
+            codes = ['a', 'b'] if list_status == 'L' else []
+            return pd.DataFrame({'ts_code': codes})
+
+    class Throttle(AdaptiveThrottle):
+        acquired = backoffs = 0
+
+        def acquire(self, tokens=1):
+            Throttle.acquired += 1
+
+        def backoff(self):
+            Throttle.backoffs += 1
+            super().backoff()
+
+    throttle = Throttle(6000)
+    monkeypatch.setitem(sys.modules, 'tushare',
+                        types.SimpleNamespace(pro_api=Pro))
+    monkeypatch.setattr(model, 'rate_limit', lambda source, cpm: throttle)
+    calls = []
+
+    def download(code, pro, enddate):
+        calls.append(code)
+        if len(calls) <= 15:
+            raise Exception('抱歉，您每分钟最多访问该接口200次')
+        if enddate < datetime(2020, 1, 1):
+            return pd.DataFrame(columns=['ts_code', 'trade_date', 'close'])
+        dates = pd.date_range(datetime(2020, 1, 1), enddate)
+        return pd.DataFrame({'ts_code': code, 'trade_date': dates, 'close': 1.0})
+
+    col = model._TushareCollectionBase(
+        mongomock.MongoClient()['test']['test'],
+        {'code_name': 'ts_code', 'date_name': 'trade_date'})
+    col._rebuild(download, workers=1, max_retry=2)
+    # Refused calls slow the throttle down instead of failing codes
+    assert Throttle.backoffs == 15
+    assert throttle.rate < throttle.max_rate
+    # Every call, retried or not, takes a token
+    assert Throttle.acquired == len(calls) + 3
+    assert sorted(col.interface.distinct('ts_code')) == ['a', 'b']
+
+
+def test_mirror_history_rewrite():
+    import tempfile
+    import mongomock
+    import pandas as pd
+    from fdm.datasources.metaclass.interface import ColInterface
+    from fdm.datasources.metaclass.mirror import ParquetMirror
+
+    col = mongomock.MongoClient()['test']['test']
+    interface = ColInterface(col, test_config['Test']['DBSetting'])
+    for code in ('abc', 'cde'):
+        interface.insert_many(ord_test_feeder_func(
+            code, 'close', datetime(2018, 12, 1), datetime(2019, 1, 31)))
+    mirror = ParquetMirror(interface, tempfile.mkdtemp(), fresh_ttl=3600)
+    mirror.sync()
+
+    calls = []
+    write_state = interface.write_state
+    interface.write_state = lambda: calls.append(1) or write_state()
+    assert mirror.is_fresh() and mirror.is_fresh()
+    # Checked once until the next write
+    assert len(calls) == 1
+
+    # Rewrite 2018 of one code, the last date stays the same
+    interface.delete_by_code('abc')
+    df = ord_test_feeder_func('abc', 'close', datetime(2018, 12, 1), datetime(2019, 1, 31))
+    df['close'] = 'rewritten'
+    interface.insert_many(df)
+    assert not mirror.is_fresh()
+    assert mirror.sync() == ['2018', '2019']
+    assert mirror.is_fresh()
+    res = mirror.read('abc', datetime(2018, 12, 1), datetime(2018, 12, 31))
+    assert len(res) == 31 and (res['close'] == 'rewritten').all()
+
+    # Writes from another process are seen once the cached check expires
+    other = ColInterface(col, test_config['Test']['DBSetting'])
+    other.delete_by_date(datetime(2018, 12, 3))
+    assert mirror.is_fresh()
+    mirror.fresh_ttl = 0
+    mirror._fresh = None
+    assert not mirror.is_fresh()
+    assert mirror.sync() == ['2018', '2019']
+    assert len(mirror.read(startdate=datetime(2018, 12, 1),
+                           enddate=datetime(2018, 12, 31))) == 60
+
+
+def test_jqdata_http_transport():
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from fdm.datasources.joinquant.api import JQDataAPI, QuotaExhaustedError
+
+    requests = []
+    ports = set()
+
+    class Stub(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        tokens = 0
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            requests.append(body)
+            ports.add(self.client_address[1])
+            if body['method'] == 'get_token':
+                Stub.tokens += 1
+                text = 'token{0}'.format(Stub.tokens)
+            elif body['token'] != 'token{0}'.format(Stub.tokens):
+                text = 'error: token过期，请重新获取'
+            elif body['code'] == 'quota':
+                text = 'error: 您当天的查询条数超过了每日最大查询限制：1000000条'
+            else:
+                text = 'date,close\n2019-01-02,1.0\n2019-01-03,2.0\n'
+            data = text.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Stub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = JQDataAPI.__URL__
+    try:
+        JQDataAPI.configure(pool_size=2, timeout=10,
+                            url='http://127.0.0.1:{0}/apis'.format(server.server_port))
+        JQDataAPI.auth('user', 'password')
+        api = JQDataAPI()
+        start, end = datetime(2019, 1, 1), datetime(2019, 1, 31)
+        assert len(api.get_price_period('abc', start, end)) == 2
+        # Token expired on the server, a new one is fetched and the call sent again
+        Stub.tokens += 1
+        res = api.get_price_period('abc', start, end)
+        assert list(res['close']) == [1.0, 2.0]
+        assert [b['method'] for b in requests] == [
+            'get_token', 'get_price_period', 'get_price_period',
+            'get_token', 'get_price_period']
+        assert requests[-1]['token'] == 'token3'
+        # Quota error text becomes QuotaExhaustedError
+        try:
+            api.get_price_period('quota', start, end)
+            assert False
+        except QuotaExhaustedError:
+            pass
+        # Every call went through one kept-alive connection
+        assert len(requests) == 6 and len(ports) == 1
+    finally:
+        JQDataAPI.configure(url=url)
+        server.shutdown()
+        server.server_close()
+
+
+def test_jqdata_fs_prefetch_per_code(monkeypatch):
+    import threading
+    import types
+    from fdm.datasources.joinquant.api import JQDataAPI
+    from fdm.datasources.joinquant.feeder import FS_temp
+    from fdm.utils.cache import download_cache
+    from datetime import timedelta
+    from fdm.utils.data_structure.bubbles import TimeBubble
+
+    bodies = []
+    threads = set()
+
+    def post(body):
+        bodies.append(body)
+        threads.add(threading.get_ident())
+        if body['method'] == 'get_query_count':
+            return types.SimpleNamespace(text='1000000')
+        sleep(0.01)
+        code = body['conditions'].split('code#=#')[1].split('&')[0]
+        text = ('code,report_date,pub_date,start_date,end_date,total_profit\n'
+                '{0},2019-03-31,2019-04-20,2019-01-01,2019-03-31,1.0\n').format(code)
+        return types.SimpleNamespace(text=text if code != 'empty' else
+                                     text.split('\n')[0] + '\n')
+
+    monkeypatch.setattr(JQDataAPI, '_post', staticmethod(post))
+    monkeypatch.setattr(JQDataAPI, '__TOKEN__', 'token')
+    start, end = datetime(2019, 1, 1), datetime(2019, 12, 31)
+    codes = ['code_' + str(i) for i in range(20)] + ['empty']
+    gaps = [TimeBubble(start, end + timedelta(1))]
+    params = [(code, 'total_profit', None, gaps) for code in codes]
+    assert FS_temp('income').prefetch(params) == params
+
+    queries = [b for b in bodies if b['method'] == 'run_query']
+    # One code#=# condition per code, sent from several threads
+    assert len(queries) == len(codes)
+    assert all('#in#' not in b['conditions'] for b in queries)
+    assert len(threads) > 1
+    for code in codes:
+        df = download_cache.pop(('JQData', 'FS', 'income', code, start, end))
+        assert list(df['code']) == ([] if code == 'empty' else [code])
+        if code != 'empty':
+            assert df['date'].iloc[0] == datetime(2019, 3, 31)
+
+
+def test_query_years_concurrently():
+    import threading
+    import mongomock
+    import pandas as pd
+    from fdm.datasources.metaclass.interface import ColInterface
+
+    interface = ColInterface(mongomock.MongoClient()['test']['test'],
+                             test_config['Test']['DBSetting'])
+    for code in ('abc', 'cde', 'efg'):
+        interface.insert_many(ord_test_feeder_func(
+            code, 'close', datetime(2016, 6, 1), datetime(2019, 6, 30)))
+    threads = set()
+    find_frame = interface._find_frame
+
+    def traced(*args, **kwargs):
+        threads.add(threading.get_ident())
+        sleep(0.05)
+        return find_frame(*args, **kwargs)
+
+    interface._find_frame = traced
+    for kwargs in ({'startdate': datetime(2016, 12, 1), 'enddate': datetime(2019, 2, 1)},
+                   {'startdate': datetime(2016, 12, 1), 'enddate': datetime(2019, 2, 1),
+                    'freq': 'M'},
+                   {'date': [datetime(2019, 1, 2), datetime(2017, 3, 1),
+                             datetime(2016, 7, 1)]}):
+        threads.clear()
+        serial = interface.query(['abc', 'efg'], workers=1, **kwargs)
+        assert len(threads) == 1
+        threads.clear()
+        res = interface.query(['abc', 'efg'], workers=4, **kwargs)
+        assert len(threads) > 1
+        # Same records in the same year order as one find after another
+        pd.testing.assert_frame_equal(res, serial)
+        assert res['date'].dt.year.is_monotonic_increasing
+    assert len(serial) == 6 and set(serial['code']) == {'abc', 'efg'}
+
+
+def test_rolling_query_matches_period_queries():
+    from datetime import timedelta
+    import mongomock
+    import pandas as pd
+    from fdm.datasources.metaclass.interface import ColInterface
+
+    interface = ColInterface(mongomock.MongoClient()['test']['test'],
+                             test_config['Test']['DBSetting'])
+    for code in ('abc', 'cde'):
+        df = ord_test_feeder_func(code, 'close', datetime(2018, 11, 1), datetime(2019, 2, 28))
+        # Leave holes, some periods have no record at all
+        holes = pd.date_range(datetime(2018, 12, 20), datetime(2019, 1, 8))
+        df = df[~df['date'].isin(holes) & (df['date'].dt.day % (3 if code == 'abc' else 4) != 0)]
+        interface.insert_many(df)
+
+    def reference(window, start, end, freq, ascending, fillna):
+        '''One query per period, as rolling_query used to do.'''
+        dates = pd.date_range(start, end, freq=freq, normalize=True).sort_values(
+            ascending=ascending)
+        periods = []
+        for date in dates:
+            low = pd.date_range(end=date, periods=2, freq=freq)[0] + timedelta(1)
+            df = interface.query(['abc', 'cde'], startdate=low.to_pydatetime(),
+                                 enddate=date.to_pydatetime(), freq=freq, fillna=fillna)
+            if not df.empty:
+                periods.append(df)
+                if len(periods) >= window:
+                    yield pd.concat(periods[-window:])
+
+    def normalize(df):
+        df = df.sort_values(['date', 'code'])
+        return df.reset_index(drop=True)[['code', 'date', 'close']]
+
+    for freq in ('B', 'W-FRI', 'M'):
+        for fillna in ('ffill', 'bfill', None):
+            for ascending in (True, False):
+                args = (3, datetime(2018, 11, 15), datetime(2019, 2, 15), freq, ascending, fillna)
+                expected = list(reference(*args))
+                res = list(interface.rolling_query(
+                    3, ['abc', 'cde'], args[1], args[2], freq=freq,
+                    ascending=ascending, fillna=fillna))
+                assert len(res) == len(expected), (freq, fillna, ascending)
+                assert len(res) > 0 or (freq, fillna) == ('M', None)
+                for a, b in zip(res, expected):
+                    pd.testing.assert_frame_equal(normalize(a), normalize(b))
+
+
+def test_field_status_batched_flush():
+    import mongomock
+    from fdm.datasources.metaclass.manager import Manager
+    from fdm.utils.data_structure import Bubbles
+
+    manager = Manager(mongomock.MongoClient()['test']['test'])
+    writes = []
+    bulk_write = manager.status.col.bulk_write
+
+    def traced(requests, **kwargs):
+        writes.append(len(requests))
+        return bulk_write(requests, **kwargs)
+
+    manager.status.col.bulk_write = traced
+    bubbles = Bubbles([[datetime(2019, 1, 1), datetime(2019, 2, 1)]])
+    for code in ('abc', 'cde.sh'):
+        for field in ('close', 'open', 'high'):
+            manager[code, field] = bubbles
+    # Nothing written until flush, then one upsert per code
+    assert manager.status.col.count_documents({}) == 0
+    manager.flush()
+    assert writes == [2]
+    status = manager.status[['cde.sh'], ['open']]
+    assert status['CDE~SH', 'OPEN'].to_list() == bubbles.to_list()
+    assert manager.status.fields.get_fields() == {'CLOSE', 'OPEN', 'HIGH'}
+    manager.flush()
+    assert writes == [2]
+
+    # Reads see pending writes
+    manager['abc', 'close'] = Bubbles()
+    assert manager.status[['abc'], ['close']]['ABC', 'CLOSE'].isempty
+    assert writes == [2, 1]
+
+    # Flushed automatically once batch_size assignments are pending
+    manager.status.batch_size = 4
+    for i in range(9):
+        manager['code_' + str(i), 'close'] = bubbles
+    assert writes == [2, 1, 4, 4]
+    manager.flush()
+    assert writes == [2, 1, 4, 4, 1]
+    assert manager.status.col.count_documents({}) == 11
+
+
+def test_bubbles_match_day_sets():
+    import random
+    from datetime import timedelta
+    from fdm.utils.data_structure import Bubbles
+    from fdm.utils.data_structure.bubbles import TimeBubble
+
+    rand = random.Random(0)
+    origin = datetime(2019, 1, 1)
+
+    def day(i):
+        return origin + timedelta(i)
+
+    def rand_range():
+        lo = rand.randint(0, 60)
+        return [day(lo), day(lo + rand.randint(0, 10))]
+
+    def days(bubbles):
+        '''Model of a bubbles as the set of days it holds.'''
+        res = set()
+        for b in bubbles:
+            res.update(range(b.min.toordinal(), b.max.toordinal()))
+        return res
+
+    def to_days(pair):
+        return set(range(pair[0].toordinal(), pair[1].toordinal()))
+
+    for _ in range(200):
+        pairs = [rand_range() for _ in range(rand.randint(0, 8))]
+        bubbles = Bubbles(pairs)
+        expected = set().union(*(to_days(p) for p in pairs))
+        assert days(bubbles) == expected
+        # Disjoint, sorted and not touching
+        bounds = bubbles.to_list()
+        for (_, hi), (lo, _) in zip(bounds[:-1], bounds[1:]):
+            assert hi < lo
+        assert bubbles.isempty == (len(expected) == 0)
+
+        other = rand_range()
+        assert days(bubbles.merge(other)) == expected | to_days(other)
+        assert days(bubbles.carve(other)) == expected - to_days(other)
+        assert days(bubbles.intersect(other)) == expected & to_days(other)
+        if other[0] < other[1]:
+            assert days(bubbles.gaps(other)) == to_days(other) - expected
+            assert (TimeBubble(*other) in bubbles) == (to_days(other) <= expected)
+        for i in range(-1, 72, 7):
+            assert (day(i) in bubbles) == (day(i).toordinal() in expected)
+        if not bubbles.isempty:
+            assert bubbles.min.toordinal() == min(expected)
+            assert bubbles.max.toordinal() == max(expected) + 1
+            inner = to_days([bubbles.min, bubbles.max])
+            assert days(bubbles.gaps()) == inner - expected
+
+
+def test_time_bubble():
+    from datetime import timedelta
+    from fdm.utils.data_structure.bubbles import TimeBubble
+
+    bubble = TimeBubble(datetime(2018, 12, 30), datetime(2019, 1, 3))
+    assert not hasattr(bubble, '__dict__')
+    assert (bubble.min, bubble.max) == (datetime(2018, 12, 30), datetime(2019, 1, 3))
+    assert bubble.leg == 4 and str(bubble) == '[2018-12-30, 2019-01-03)'
+    assert list(bubble) == [datetime(2018, 12, 30) + timedelta(i) for i in range(4)]
+    assert bubble.to_actualrange() == [datetime(2018, 12, 30), datetime(2019, 1, 2)]
+    assert bubble.to_mongodb_date_range() == {'$gte': datetime(2018, 12, 30),
+                                              '$lt': datetime(2019, 1, 3)}
+    assert datetime(2019, 1, 2) in bubble and datetime(2019, 1, 3) not in bubble
+    assert [b.to_list() for b in bubble.iter_years()] == [
+        [datetime(2018, 12, 30), datetime(2019, 1, 1)],
+        [datetime(2019, 1, 1), datetime(2019, 1, 3)]]
+
+    weekly = TimeBubble(datetime(2019, 1, 1), datetime(2019, 1, 22), timedelta(7))
+    assert list(weekly) == [datetime(2019, 1, 1), datetime(2019, 1, 8), datetime(2019, 1, 15)]
+    assert weekly.to_actualrange()[1] == datetime(2019, 1, 15)
+
+    other = TimeBubble(datetime(2019, 1, 2), datetime(2019, 1, 10))
+    assert bubble.merge(other)[0].to_list() == [datetime(2018, 12, 30), datetime(2019, 1, 10)]
+    assert bubble.intersect(other).to_list() == [datetime(2019, 1, 2), datetime(2019, 1, 3)]
+    left, right = bubble.carve(other)
+    assert left.to_list() == [datetime(2018, 12, 30), datetime(2019, 1, 2)] and right is None
+    far = TimeBubble(datetime(2019, 2, 1), datetime(2019, 2, 2))
+    assert bubble.merge(far) == (bubble, far) and bubble.intersect(far) is None
+    try:
+        TimeBubble(datetime(2019, 1, 2), datetime(2019, 1, 1))
+        assert False
+    except ValueError:
+        pass
+
+
+def test_concurrent_feeders():
+    import threading
+    import mongomock
+    import pandas as pd
+
+    lock = threading.Lock()
+    state = {'running': 0, 'most': 0}
+
+    def feeder(code, field, start, end):
+        with lock:
+            state['running'] += 1
+            state['most'] = max(state['most'], state['running'])
+        sleep(0.02)
+        with lock:
+            state['running'] -= 1
+        if code == 'bad':
+            raise ValueError('feeder failed')
+        return ord_test_feeder_func(code, field, start, end)
+
+    codes = ['code_' + str(i) for i in range(12)] + ['bad']
+    results = []
+    # One database per run, concurrency is bounded per source
+    for name, workers in (('feeders_serial', 1), ('feeders_pool', 4)):
+        state['most'] = 0
+        setting = dict(test_config['Test']['DBSetting'], feeder_workers=workers)
+        interface = StaColInterface(mongomock.MongoClient()[name]['test'], feeder, setting)
+        res = interface.query(codes, ['cdb', 'cde'], datetime(2019, 1, 1),
+                              datetime(2019, 1, 10))
+        assert state['most'] == workers
+        results.append(res)
+        # A failed code leaves no status behind, others are recorded
+        status = interface.manager.status[codes, ['cdb']]
+        assert status['BAD', 'CDB'].isempty
+        assert not status['CODE_11', 'CDB'].isempty
+    for field in ('CDB', 'CDE'):
+        serial, pool = (res[field] for res in results)
+        assert 'BAD' not in pool.columns
+        pd.testing.assert_frame_equal(pool[sorted(pool.columns)],
+                                      serial[sorted(serial.columns)])
+    assert results[1]['CDE']['CODE_7'].iloc[-1] == 'code_7cde20190110'
+
+
+def test_write_wide():
+    import mongomock
+    import numpy as np
+    import pandas as pd
+
+    interface = StaColInterface(mongomock.MongoClient()['test']['test'],
+                                ord_test_feeder_func, test_config['Test']['DBSetting'])
+    subcol = interface.col['CLOSE']
+    interface._create_field_index(subcol)
+    dates = pd.date_range(datetime(2019, 1, 1), periods=6)
+    values = np.arange(42, dtype='float64').reshape(6, 7)
+    values[values % 5 == 0] = np.nan
+    values[3] = np.nan
+    df = pd.DataFrame(values, index=dates, columns=['C' + str(i) for i in range(7)])
+    requests = []
+    bulk_write = subcol.bulk_write
+
+    def traced(bulks, **kwargs):
+        requests.append(len(bulks))
+        return bulk_write(bulks, **kwargs)
+
+    subcol.bulk_write = traced
+    # Columns in blocks of 3, requests in chunks of 4
+    interface._write_wide(subcol, df, block_size=3, chunk_size=4)
+    # Nothing written for a row block without any value, e.g. 20 alone in the last block
+    assert sum(requests) == 5 * 3 - 1 and max(requests) == 4
+    # Later writes add columns to existing dates
+    more = pd.DataFrame({'D0': [1.0, np.nan]}, index=dates[:2])
+    interface._write_wide(subcol, more)
+
+    docs = {doc['date']: doc for doc in subcol.find({}, {'_id': 0})}
+    assert len(docs) == 5 and dates[3] not in docs
+    for i, date in enumerate(dates):
+        for j, code in enumerate(df.columns):
+            if np.isnan(values[i, j]):
+                assert code not in docs.get(date, {})
+            else:
+                assert docs[date][code] == values[i, j]
+    assert docs[dates[0]]['D0'] == 1.0 and 'D0' not in docs[dates[1]]
+
+
+def test_benchmark_smoke(capsys):
+    import json
+    import os
+    import tempfile
+    import benchmark
+
+    backend, ctx = benchmark.open_backend('mongomock')
+    with ctx as client:
+        results = benchmark.run(client, backend, 3, 1, 1)
+        assert client.list_database_names() == []
+    names = [r['name'] for r in results]
+    assert len(names) == len(set(names))
+    assert 'ColInterface.query' in names and 'StaColInterface.query with update' in names
+    assert 'ColInterface.query columnar' not in names
+    assert all(len(r['runs']) == 1 and r['min'] >= 0 for r in results)
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.json')
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(json.dumps({'results': results}))
+    capsys.readouterr()
+    benchmark.compare(results, path)
+    lines = capsys.readouterr().out.strip().split('\n')
+    assert len(lines) == len(results) + 1
+    assert all(line.endswith('1.00') for line in lines[1:])
+
+
+def test_download_cache_budget_and_ttl(monkeypatch):
+    import pandas as pd
+    from fdm.utils import cache
+
+    now = [1000.0]
+    monkeypatch.setattr(cache, 'monotonic', lambda: now[0])
+
+    def frame(n):
+        return pd.DataFrame({'close': [1.0] * n})
+
+    size = int(frame(100).memory_usage(index=True, deep=True).sum())
+    downloads = cache.DownloadCache(max_bytes=3 * size, ttl=60)
+    for key in 'abc':
+        downloads.put(key, frame(100))
+    assert downloads.nbytes == 3 * size
+    # Reading a moves it last, b is the least recently used
+    assert downloads.get('a') is not None
+    downloads.put('d', frame(100))
+    assert 'b' not in downloads and all(k in downloads for k in 'acd')
+    assert downloads.nbytes == 3 * size
+    assert downloads.pop('c') is not None and downloads.pop('c') is None
+    assert downloads.nbytes == 2 * size
+
+    # An entry over budget is kept alone
+    downloads.put('big', frame(1000))
+    assert len(downloads) == 1 and 'big' in downloads
+
+    # Entries expire after ttl
+    downloads.put('e', frame(10))
+    now[0] += 30
+    downloads.put('f', frame(10))
+    now[0] += 31
+    assert 'e' not in downloads and downloads.get('e') is None
+    assert downloads.get('f') is not None
+    now[0] += 30
+    downloads.put('g', frame(10))
+    assert len(downloads) == 1
+    stats = downloads.stats()
+    assert stats['entries'] == 1 and stats['nbytes'] == downloads.nbytes
+    assert stats['hits'] == 3 and stats['misses'] == 2
+    # b, a, d and big for the budget, e and f for ttl
+    assert stats['evictions'] == 6
+
+
+def test_tushare_update_by_date(monkeypatch):
+    import sys
+    import threading
+    import types
+    import mongomock
+    import pandas as pd
+    from fdm.datasources.tushare import model
+    from fdm.utils.concurrency import AdaptiveThrottle
+
+    dates = ['20181228', '20190102', '20190103', '20190104', '20190107', '20190108']
+
+    class Pro:
+        def trade_cal(self, exchange, start_date, end_date, is_open):
+            assert start_date == '20181228'
+            return pd.DataFrame({'cal_date': list(reversed(dates))})
+
+    monkeypatch.setitem(sys.modules, 'tushare', types.SimpleNamespace(pro_api=Pro))
+    monkeypatch.setattr(model, 'rate_limit',
+                        lambda source, cpm: AdaptiveThrottle(60000))
+    threads = set()
+
+    def download(date, pro):
+        threads.add(threading.get_ident())
+        sleep(0.02)
+        if date == '20190107':
+            raise ValueError('no data')
+        return pd.DataFrame({'ts_code': ['a', 'b'],
+                             'trade_date': pd.to_datetime([date, date]),
+                             'close': 1.0})
+
+    col = model._TushareCollectionBase(
+        mongomock.MongoClient()['test']['test'],
+        {'code_name': 'ts_code', 'date_name': 'trade_date'})
+    col.interface.insert_many(pd.DataFrame({
+        'ts_code': ['a'], 'trade_date': [datetime(2018, 12, 27)], 'close': 1.0}))
+    inserts = []
+    insert_many = col.interface.insert_many
+    col.interface.insert_many = lambda df: inserts.append(
+        sorted(set(df['trade_date'].dt.strftime('%Y%m%d')))) or insert_many(df)
+    col._update(download, workers=4, max_retry=1)
+
+    assert len(threads) > 1
+    # One write per year, in date order, nothing after the failed day
+    assert inserts == [['20181228'], ['20190102', '20190103', '20190104']]
+    assert col.interface.lastdate() == datetime(2019, 1, 4)
+
+
+def test_adaptive_throttle():
+    from fdm.utils.concurrency import AdaptiveThrottle
+
+    throttle = AdaptiveThrottle(600, min_rate=60, increase=60)
+    assert throttle.rate == throttle.max_rate == 10
+    for _ in range(5):
+        throttle.backoff()
+    # Halved on every refusal, down to min_rate
+    assert throttle.rate == 1
+    assert throttle._tokens <= 0
+    for _ in range(5):
+        throttle.success()
+    assert throttle.rate == 6
+    for _ in range(10):
+        throttle.success()
+    assert throttle.rate == throttle.max_rate
+
+
+def test_wind_session(monkeypatch):
+    from fdm.datasources.wind import feeder
+    from fdm.datasources.wind.session import WindSession
+    from fdm.utils.exceptions import FeederFunctionError
+    from fdm.utils.test import FakeWindPy, WindData
+
+    w = FakeWindPy()
+    session = WindSession(w)
+    monkeypatch.setattr(feeder, 'session', session)
+    edb = feeder.edb()
+    start, end = datetime(2019, 1, 1), datetime(2019, 1, 31)
+    for code in ('M001', 'M002', 'M003'):
+        df = edb(None, code, 'close', start, end)
+        assert df['close'].iloc[-1] == code + 'close20190131'
+    # Started once for every call
+    assert session.starts == 1 and w.calls == {'start': 1, 'edb': 3}
+
+    # A dropped connection is started again when borrowed
+    w.disconnect()
+    df = edb(None, 'M001', 'close', start, end)
+    assert len(df) == 23
+    assert session.starts == 2 and w.calls['edb'] == 4
+
+    # Dropped after the check, the call is retried once on a new start
+    isconnected = w.isconnected
+    w.isconnected = lambda: True
+    w.disconnect()
+    df = edb(None, 'M001', 'close', start, end)
+    assert len(df) == 23
+    assert session.starts == 3 and w.calls['edb'] == 6
+    w.isconnected = isconnected
+
+    # Terminal refused to start
+    class Refused(FakeWindPy):
+        def start(self, waitTime=120):
+            return WindData(ErrorCode=-2)
+
+    session.use(Refused())
+    try:
+        edb(None, 'M001', 'close', start, end)
+        assert False
+    except FeederFunctionError:
+        pass
+    session.use(w)
+    assert len(edb(None, 'M001', 'close', start, end)) == 23
+    session.stop()
+    assert not w.isconnected()
+
+
+def test_wind_wsd_batches(monkeypatch):
+    import mongomock
+    from fdm.datasources.wind import feeder
+    from fdm.datasources.wind.model import WSD
+    from fdm.datasources.wind.session import WindSession
+    from fdm.utils.test import FakeWindPy
+
+    w = FakeWindPy()
+    monkeypatch.setattr(feeder, 'session', WindSession(w))
+
+    class SmallWSD(WSD):
+        feeder_func = feeder.wsd(codes_per_call=2)
+
+    wsd = SmallWSD(mongomock.MongoClient()['wind_wsd']['wsd'],
+                   test_config['Test']['DBSetting'])
+    codes = ['00000{0}.SZ'.format(i) for i in range(1, 6)]
+    start, end = datetime(2019, 1, 1), datetime(2019, 1, 31)
+    res = wsd.query(codes, ['close', 'open'], start, end)
+    # Codes split in calls of 2, one field per call
+    assert w.calls['wsd'] == 3 * 2
+    for field in ('CLOSE', 'OPEN'):
+        df = res[field].set_index('date')
+        assert sorted(df.columns) == codes
+        assert len(df) == 23
+        for code in codes:
+            assert df[code].iloc[-1] == code + field.lower() + '20190131'
+    # Nothing downloaded again
+    wsd.query(codes, ['close', 'open'], start, end)
+    assert w.calls['wsd'] == 6
+
+
+def test_packed_matches_wide():
+    import mongomock
+    import pandas as pd
+    from fdm.datasources.metaclass.interface import PackedStaColInterface
+
+    def feeder(code, field, start, end):
+        df = ord_test_feeder_func(code, field, start, end)
+        if field == 'close':
+            # Numeric values with holes, one code trading every other day
+            df[field] = [float(i) for i in range(len(df))]
+            if code == 'cde.sh':
+                df = df.iloc[::2]
+        return df
+
+    codes = ['abc', 'cde.sh', 'efg']
+    fields = ['close', 'name']
+    client = mongomock.MongoClient()
+    wide = StaColInterface(client['wide']['test'], feeder, test_config['Test']['DBSetting'])
+    packed = PackedStaColInterface(client['packed']['test'], feeder,
+                                   test_config['Test']['DBSetting'])
+    for start, end in ((datetime(2018, 12, 20), datetime(2019, 1, 10)),
+                       (datetime(2018, 12, 1), datetime(2019, 2, 1)),
+                       (datetime(2018, 12, 31), datetime(2019, 1, 1))):
+        res = [i.query(codes, fields, start, end) for i in (wide, packed)]
+        for field in ('CLOSE', 'NAME'):
+            a, b = (r[field].set_index('date').sort_index() for r in res)
+            assert sorted(a.columns) == ['ABC', 'CDE.SH', 'EFG']
+            pd.testing.assert_frame_equal(b[sorted(b.columns)], a[sorted(a.columns)],
+                                          check_dtype=False)
+    # Read back in long format
+    for field in ('CLOSE', 'NAME'):
+        a, b = (pd.concat(i.iter_field(field)).sort_values(['date', 'code'])
+                .reset_index(drop=True) for i in (wide, packed))
+        pd.testing.assert_frame_equal(a, b, check_dtype=False)
+    assert packed.col['CLOSE'].count_documents({}) == 3 * 2
+
+
+def test_iter_query_chunks():
+    import mongomock
+    import pandas as pd
+    from fdm.datasources.metaclass.interface import ColInterface
+
+    interface = ColInterface(mongomock.MongoClient()['test']['test'],
+                             test_config['Test']['DBSetting'])
+    for code in ('abc', 'cde', 'efg'):
+        interface.insert_many(ord_test_feeder_func(
+            code, 'close', datetime(2018, 12, 20), datetime(2019, 1, 10)))
+
+    def sort(df):
+        return df.sort_values(['date', 'code']).reset_index(drop=True)[
+            ['code', 'date', 'close']]
+
+    for kwargs in ({},
+                   {'code_list_or_str': ['abc', 'efg'],
+                    'startdate': datetime(2018, 12, 25), 'enddate': datetime(2019, 1, 5)},
+                   {'startdate': datetime(2018, 12, 1), 'enddate': datetime(2019, 1, 31),
+                    'freq': 'W-FRI'},
+                   {'date': [datetime(2019, 1, 2), datetime(2018, 12, 31)]}):
+        chunks = list(interface.iter_query(chunk_size=7, **kwargs))
+        expected = interface.query(**kwargs)
+        assert all(0 < len(c) <= 7 for c in chunks)
+        # Years are read one after another, chunks never span two
+        assert all(c['date'].dt.year.nunique() == 1 for c in chunks)
+        res = pd.concat(chunks, ignore_index=True)
+        assert res['date'].is_monotonic_increasing and '_id' not in res.columns
+        pd.testing.assert_frame_equal(sort(res), sort(expected))
+        streamed = pd.concat(interface.query(stream=True, **kwargs), ignore_index=True)
+        pd.testing.assert_frame_equal(sort(streamed), sort(expected))
+
+    # 12 days of 2018 and 10 days of 2019
+    chunks = list(interface.iter_query(chunk_size=12))
+    assert [len(c) for c in chunks] == [12, 12, 12, 12, 12, 6]
+    assert list(interface.iter_query(startdate=datetime(2020, 1, 1))) == []
+
+
+def test_dump_partitions():
+    import os
+    import tempfile
+    import mongomock
+    import pandas as pd
+    from fdm.datasources.metaclass.base import _CollectionBase, _DynCollectionBase
+
+    client = mongomock.MongoClient()
+    col = _CollectionBase(client['test']['test'], test_config['Test']['DBSetting'])
+    for code in ('abc', 'cde'):
+        col.interface.insert_many(ord_test_feeder_func(
+            code, 'close', datetime(2018, 12, 25), datetime(2019, 1, 5)))
+    dyn = _DynCollectionBase(client['dyn']['test'], test_config['Test']['DBSetting'])
+    dyn.update(['abc', 'cde.sh'], ['close', 'open'], datetime(2019, 1, 1),
+               datetime(2019, 1, 10))
+
+    def read(file):
+        if file.endswith('.csv'):
+            return pd.read_csv(file, parse_dates=['date'])
+        return pd.read_parquet(file)
+
+    def sort(df):
+        return df.sort_values(['date', 'code']).reset_index(drop=True)[
+            ['code', 'date', 'close']]
+
+    for file_format in ('csv', 'parquet'):
+        path = tempfile.mkdtemp()
+        files = col.batch_dump(batch_size=5, path=path, file_format=file_format,
+                               workers=2)
+        assert files == [os.path.join(path, '{0}.{1}'.format(y, file_format))
+                         for y in ('2018', '2019')]
+        for year, file in zip((2018, 2019), files):
+            expected = col.interface.query(startdate=datetime(year, 1, 1),
+                                           enddate=datetime(year, 12, 31))
+            pd.testing.assert_frame_equal(sort(read(file)), sort(expected))
+
+        files = dyn.batch_dump(batch_size=5, path=path, file_format=file_format)
+        assert [os.path.basename(f) for f in files] == [
+            'CLOSE.' + file_format, 'OPEN.' + file_format]
+        df = read(files[0])
+        assert len(df) == 20 and sorted(set(df['code'])) == ['ABC', 'CDE.SH']
+        row = df[(df['code'] == 'CDE.SH') & (df['date'] == datetime(2019, 1, 10))]
+        assert list(row['CLOSE']) == ['cde.shclose20190110']
+        # Written under a temporary name first
+        assert not any(f.endswith('.tmp') for f in os.listdir(path))
+
+    # Without path batches of batch_size records
+    assert [len(df) for df in col.batch_dump(batch_size=5)] == [5, 5, 5, 5, 4]
+    try:
+        col.batch_dump(path=tempfile.mkdtemp(), file_format='xlsx')
+        assert False
+    except KeyError:
+        pass
+
+
 def test_wind_wsd():
     codes = '000002.SZ,000004.SZ'.split(
         ',')